@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+
+import gzip
+import mimetypes
+import os
+from hashlib import sha256
+from threading import Lock
+
+from flask import Response, abort, request, url_for
+
+try:
+    import brotli
+except ImportError:  # Brotli variants are only served if it is installed
+    brotli = None
+
+FINGERPRINT_LENGTH = 12
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Content types worth compressing. Images other than SVG and icons are
+# already compressed.
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/javascript",
+    "application/json",
+    "application/manifest+json",
+    "application/xml",
+    "image/svg+xml",
+    "image/vnd.microsoft.icon",
+    "image/x-icon",
+)
+
+mimetypes.add_type("application/manifest+json", ".webmanifest")
+
+
+class StaticAsset:
+    """A file from the static folder, held in memory along with any
+    compressed variants that are smaller than the original."""
+
+    def __init__(self, path, filename):
+        with open(path, "rb") as f:
+            self.content = f.read()
+        self.digest = sha256(self.content).hexdigest()[:FINGERPRINT_LENGTH]
+        self.mimetype = (
+            mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        )
+
+        stem, dot, extension = filename.rpartition(".")
+        if dot and "/" not in extension:
+            self.fingerprinted = f"{stem}.{self.digest}.{extension}"
+        else:
+            self.fingerprinted = f"{filename}.{self.digest}"
+
+        self.variants = {}
+        if self.mimetype.startswith(COMPRESSIBLE_TYPES):
+            self._add_variant("gzip", gzip.compress(self.content, 9, mtime=0))
+            if brotli is not None:
+                self._add_variant("br", brotli.compress(self.content))
+
+    def _add_variant(self, encoding, content):
+        if len(content) < len(self.content):
+            self.variants[encoding] = content
+
+
+class StaticAssets:
+    """Serves the files in the app's static folder at URLs containing a hash
+    of their content (e.g. /assets/style.0123456789ab.css), so that browsers
+    can cache them for a year and a changed file is fetched from its new URL.
+
+    Files are read, hashed and compressed when the first URL is requested or
+    asset is served, rather than when the app is created, so that CLI
+    commands don't pay for it. Changes to them are only picked up when the
+    app is restarted. Templates get the URL of a file with
+    asset_url(filename), which falls back to the plain static URL for files
+    that weren't found.
+    """
+
+    def __init__(self, app=None):
+        self.static_folder = None
+        self._manifest = None
+        self._lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.static_folder = app.static_folder
+        app.add_url_rule("/assets/<path:filename>", "asset", self.serve)
+        app.add_template_global(self.url, "asset_url")
+
+    def _load(self):
+        """Returns an (assets by fingerprinted filename, fingerprinted
+        filenames by filename) tuple, reading the static folder the first
+        time it is called."""
+        if self._manifest is not None:
+            return self._manifest
+        with self._lock:
+            if self._manifest is None:
+                assets = {}
+                fingerprinted = {}
+                for directory, _, filenames in os.walk(
+                    self.static_folder or ""
+                ):
+                    for filename in filenames:
+                        path = os.path.join(directory, filename)
+                        relative_path = os.path.relpath(
+                            path, self.static_folder
+                        )
+                        relative_path = relative_path.replace(os.sep, "/")
+                        asset = StaticAsset(path, relative_path)
+                        assets[asset.fingerprinted] = asset
+                        fingerprinted[relative_path] = asset.fingerprinted
+                self._manifest = (assets, fingerprinted)
+            return self._manifest
+
+    @property
+    def assets(self):
+        return self._load()[0]
+
+    @property
+    def fingerprinted(self):
+        return self._load()[1]
+
+    def url(self, filename):
+        fingerprinted = self.fingerprinted.get(filename)
+        if fingerprinted is None:
+            return url_for("static", filename=filename)
+        return url_for("asset", filename=fingerprinted)
+
+    def serve(self, filename):
+        asset = self.assets.get(filename)
+        if asset is None:
+            abort(404)
+
+        # Prefer brotli, then gzip, if the client accepts them
+        encoding = next(
+            (
+                encoding
+                for encoding in ("br", "gzip")
+                if encoding in asset.variants
+                and request.accept_encodings[encoding] > 0
+            ),
+            None,
+        )
+        response = Response(
+            asset.variants.get(encoding, asset.content),
+            mimetype=asset.mimetype,
+        )
+        if encoding is not None:
+            response.content_encoding = encoding
+        response.vary.add("Accept-Encoding")
+        response.headers["Cache-Control"] = CACHE_CONTROL
+        response.set_etag(
+            asset.digest if encoding is None else f"{asset.digest}-{encoding}"
+        )
+        return response.make_conditional(request)
@@ -0,0 +1,802 @@
+#!/usr/bin/python3
+"""Benchmarks every page of the app against synthetic users of increasing
+size using Flask's test client and a temporary SQLite database.
+
+For each data size a user is created with that many outgoings, then each
+page is requested a number of times recording latency percentiles, the
+number of SQL statements and the peak memory allocated (via tracemalloc).
+The core calculations (User.total_outgoings,
+AnnualExpense.end_of_month_target_balance and helpers.month_count) are also
+timed directly. Results are written as JSON and can be compared with a
+previous run to catch regressions:
+
+    python benchmark.py -o before.json
+    python benchmark.py -o after.json --compare before.json
+
+With --readers, reader and writer processes then load the largest user at
+the same time to measure read throughput while writes are happening, e.g.
+to compare SQLite profiles:
+
+    python benchmark.py --sizes 1000 --readers 4 --sqlite-profile production
+
+With --users, every page is benchmarked again for one user as other users
+are added to the database, up to each of the given numbers of users. As
+every query is scoped to a user's own rows by an index, latency should stay
+flat as the database grows:
+
+    python benchmark.py --sizes 100 --users 10,100,1000,5000
+
+--concurrent-reads sets CONCURRENT_READS and --query-latency-ms delays every
+SQL statement to simulate a remote database, to measure the effect of
+reading the dashboard figures concurrently:
+
+    python benchmark.py --sizes 1000 --query-latency-ms 2 --concurrent-reads 3
+
+--database-url runs the benchmark against another database, such as a local
+PostgreSQL server, instead of a temporary SQLite database. It must be empty
+and the benchmark's tables are dropped when it finishes:
+
+    python benchmark.py --database-url postgresql://localhost/benchmark
+
+--minify and --compress turn on HTML minification and gzip compression so
+that their effect on response_bytes and CPU time (cpu_p50_ms) can be
+compared with a run without them.
+"""
+
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import sys
+import tempfile
+import tracemalloc
+from contextlib import contextmanager
+from datetime import date, datetime
+from decimal import Decimal
+from time import perf_counter, process_time, sleep
+
+import click
+from sqlalchemy import event, inspect
+from sqlalchemy.engine import Engine
+
+DEFAULT_SIZES = "10,100,1000,10000"
+PASSWORD = "benchmark"
+# Pages that change data, end the session or only redirect are not
+# benchmarked.
+SKIPPED_ENDPOINTS = (
+    "logout",
+    "static",
+    "asset",
+    "forecast_data",
+    "delete_account_handler",
+    "delete_outgoing_handler",
+    "delete_annual_expense_handler",
+)
+# Pages requested by the readers of the concurrency benchmark
+CONCURRENT_READ_PATHS = ("/", "/outgoings", "/annual-expenses", "/accounts")
+# The other users added by the multi-user benchmark each have this many
+# accounts and annual expenses, and are added this many at a time.
+OTHER_USER_ACCOUNTS = 3
+OTHER_USER_ANNUAL_EXPENSES = 6
+OTHER_USER_BATCH_SIZE = 500
+
+
+def configure_environment(database_url):
+    """main.py reads its configuration when imported, so this must be called
+    before importing it."""
+    os.environ.setdefault("SESSION_KEY", "benchmark")
+    os.environ.setdefault("PASSWORD_SALT", "benchmark")
+    os.environ["DATABASE_URL"] = database_url
+    os.environ["ENFORCE_QUERY_BUDGETS"] = "true"
+    os.environ.pop("USERNAME", None)
+
+
+def synthetic_rows(outgoing_count, account_count, annual_expense_count, rng):
+    """Returns import rows (see transfer.py) for a user with the given number
+    of accounts, outgoings and annual expenses. Roughly half of the outgoings
+    have start and end months, some of which are in the past."""
+    this_year = date.today().year
+    rows = [
+        {"type": "account", "name": f"Account {number}", "notes": None}
+        for number in range(account_count)
+    ]
+    for number in range(outgoing_count):
+        row = {
+            "type": "outgoing",
+            "account": f"Account {number % account_count}",
+            "name": f"Outgoing {number}",
+            "value": f"{rng.uniform(1, 500):.2f}",
+            "emergency_fund_excluded": rng.random() < 0.2,
+        }
+        if rng.random() < 0.5:
+            start_year = rng.randint(this_year - 5, this_year + 1)
+            row["start_month"] = f"{start_year}-{rng.randint(1, 12):02d}"
+            end_year = rng.randint(start_year + 1, start_year + 10)
+            row["end_month"] = f"{end_year}-{rng.randint(1, 12):02d}"
+        rows.append(row)
+    for number in range(annual_expense_count):
+        rows.append(
+            {
+                "type": "annual_expense",
+                "name": f"Annual Expense {number}",
+                "value": f"{rng.uniform(10, 1000):.2f}",
+                "month_paid": rng.randint(1, 12),
+            }
+        )
+    return rows
+
+
+def create_user(main, passwords, username, outgoing_count, options, rng):
+    """Creates a configured user with synthetic data and returns their id,
+    the id of one of their outgoings, accounts and annual expenses."""
+    user = main.User(username, passwords.hash_password(PASSWORD))
+    main.db.session.add(user)
+    main.db.session.commit()
+
+    main.import_rows(
+        user,
+        synthetic_rows(
+            outgoing_count,
+            max(1, min(options["accounts"], outgoing_count)),
+            options["annual_expenses"],
+            rng,
+        ),
+    )
+
+    first_outgoing = main.Outgoing.query.filter_by(user_id=user.id).first()
+    main.db.session.add(
+        main.Configuration(
+            user.id,
+            annual_expense_outgoing_id=first_outgoing.id,
+            emergency_fund_months=3,
+            annual_net_salary=36000,
+        )
+    )
+    main.db.session.commit()
+    main.AnnualExpense.update_user_annual_expense_outgoing(user)
+
+    return {
+        "user_id": user.id,
+        "outgoing_id": first_outgoing.id,
+        "account_id": first_outgoing.account_id,
+        "annual_expense_id": main.AnnualExpense.query.filter_by(
+            user_id=user.id
+        )
+        .first()
+        .id,
+    }
+
+
+def benchmarked_pages(app, ids):
+    """Returns (endpoint, path) for every GET route of the app."""
+    pages = []
+    for rule in sorted(app.url_map.iter_rules(), key=lambda r: r.rule):
+        if "GET" not in rule.methods or rule.endpoint in SKIPPED_ENDPOINTS:
+            continue
+        path = rule.rule
+        for argument in rule.arguments:
+            path = re.sub(rf"<(\w+:)?{argument}>", str(ids[argument]), path)
+        if rule.endpoint == "export_data":
+            path += "?format=csv"
+        pages.append((rule.endpoint, path))
+    return pages
+
+
+def add_other_users(main, numbers, outgoing_count, rng):
+    """Adds a user with outgoing_count outgoings for each of the numbers
+    using set based inserts, as adding thousands of users through the ORM
+    would take far longer than benchmarking them. The users can't log in."""
+    db = main.db
+    tables = {
+        model: model.__table__
+        for model in (
+            main.User,
+            main.Account,
+            main.Outgoing,
+            main.AnnualExpense,
+        )
+    }
+    annual_expenses = {
+        number: [
+            (rng.randint(1, 12), f"{rng.uniform(10, 1000):.2f}")
+            for _ in range(OTHER_USER_ANNUAL_EXPENSES)
+        ]
+        for number in numbers
+    }
+    db.session.execute(
+        tables[main.User].insert(),
+        [
+            {
+                "username": f"other-{number}",
+                "password": "",
+                "failed_login_attempts": 0,
+                "locked": True,
+                "data_version": 0,
+                "annual_expense_total": sum(
+                    Decimal(value) for _, value in annual_expenses[number]
+                ),
+            }
+            for number in numbers
+        ],
+    )
+    user_ids = dict(
+        db.session.query(main.User.username, main.User.id).filter(
+            main.User.username.in_([f"other-{number}" for number in numbers])
+        )
+    )
+    user_ids = {number: user_ids[f"other-{number}"] for number in numbers}
+
+    db.session.execute(
+        tables[main.Account].insert(),
+        [
+            {"user_id": user_id, "name": f"Account {account}"}
+            for user_id in user_ids.values()
+            for account in range(OTHER_USER_ACCOUNTS)
+        ],
+    )
+    account_ids = {}
+    for account_id, user_id in db.session.query(
+        main.Account.id, main.Account.user_id
+    ).filter(main.Account.user_id.in_(user_ids.values())):
+        account_ids.setdefault(user_id, []).append(account_id)
+
+    db.session.execute(
+        tables[main.Outgoing].insert(),
+        [
+            {
+                "user_id": user_id,
+                "name": f"Outgoing {outgoing}",
+                "value": f"{rng.uniform(1, 500):.2f}",
+                "account_id": account_ids[user_id][
+                    outgoing % OTHER_USER_ACCOUNTS
+                ],
+                "emergency_fund_excluded": False,
+            }
+            for user_id in user_ids.values()
+            for outgoing in range(outgoing_count)
+        ],
+    )
+    db.session.execute(
+        tables[main.AnnualExpense].insert(),
+        [
+            {
+                "user_id": user_ids[number],
+                "month_paid": month_paid,
+                "name": f"Annual Expense {annual_expense}",
+                "value": value,
+            }
+            for number in numbers
+            for annual_expense, (month_paid, value) in enumerate(
+                annual_expenses[number]
+            )
+        ],
+    )
+    db.session.commit()
+
+
+def benchmark_user_counts(
+    main,
+    passwords,
+    QueryCounter,
+    user_counts,
+    outgoing_count,
+    options,
+    iterations,
+    rng,
+):
+    """Benchmarks every page for a user with outgoing_count outgoings as
+    other users of the same size are added, up to each of the user counts.
+    Returns the page results by number of users."""
+    with main.app.app_context():
+        ids = create_user(
+            main, passwords, "benchmark-users", outgoing_count, options, rng
+        )
+        user_total = main.User.query.count()
+
+    client = main.app.test_client()
+    client.environ_base["HTTP_ACCEPT_ENCODING"] = "gzip, deflate, br"
+    client.post(
+        "/login-handler",
+        data={"username": "benchmark-users", "password": PASSWORD},
+    )
+
+    results = {}
+    for user_count in sorted(user_counts):
+        with main.app.app_context():
+            for start in range(user_total, user_count, OTHER_USER_BATCH_SIZE):
+                add_other_users(
+                    main,
+                    range(
+                        start, min(start + OTHER_USER_BATCH_SIZE, user_count)
+                    ),
+                    outgoing_count,
+                    rng,
+                )
+        user_total = max(user_total, user_count)
+        click.echo(f"{user_total} users", err=True)
+
+        pages = {}
+        for endpoint, path in benchmarked_pages(main.app, ids):
+            main.summary_cache.clear()
+            pages[endpoint] = benchmark_page(
+                client, path, iterations, QueryCounter
+            )
+            click.echo(f"  {endpoint:30} {pages[endpoint]}", err=True)
+        results[str(user_total)] = pages
+    return results
+
+
+def add_query_latency(seconds):
+    """Delays every SQL statement by the given number of seconds, to
+    simulate a database reached across a network."""
+
+    @event.listens_for(Engine, "before_cursor_execute")
+    def delay_query(*args):
+        sleep(seconds)
+
+
+@contextmanager
+def benchmark_database(main, temporary):
+    """Creates the app's tables for the duration of the benchmark. A
+    database given with --database-url must not have any tables, so that
+    the tables can be dropped afterwards without losing anything else."""
+    with main.app.app_context():
+        if not temporary and inspect(main.db.engine).get_table_names():
+            raise click.ClickException(
+                "The database given by --database-url must be empty."
+            )
+    main.init_database(main.app)
+    try:
+        yield
+    finally:
+        if not temporary:
+            with main.app.app_context():
+                main.db.session.remove()
+                main.db.drop_all()
+
+
+def percentile(timings, percent):
+    ordered = sorted(timings)
+    position = (len(ordered) - 1) * percent / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (
+        position - lower
+    )
+
+
+def summarise(timings):
+    """Returns latency statistics in milliseconds."""
+    return {
+        "min_ms": round(min(timings) * 1000, 3),
+        "p50_ms": round(percentile(timings, 50) * 1000, 3),
+        "p90_ms": round(percentile(timings, 90) * 1000, 3),
+        "p99_ms": round(percentile(timings, 99) * 1000, 3),
+        "max_ms": round(max(timings) * 1000, 3),
+    }
+
+
+def benchmark_page(client, path, iterations, QueryCounter):
+    """Requests a page iterations times (after one warm up request) and
+    returns its latency statistics, median CPU time, SQL statement count,
+    response size and peak memory."""
+    response = client.get(path)
+    response.get_data()  # Streamed responses are generated when read
+    result = {"status": response.status_code}
+    if response.status_code >= 400:
+        result["error"] = response.get_data(as_text=True)[-500:]
+        return result
+
+    timings = []
+    cpu_timings = []
+    for _ in range(iterations):
+        with QueryCounter() as counter:
+            start = perf_counter()
+            cpu_start = process_time()
+            response = client.get(path)
+            response.get_data()
+            cpu_timings.append(process_time() - cpu_start)
+            timings.append(perf_counter() - start)
+    result.update(summarise(timings))
+    result["cpu_p50_ms"] = round(percentile(cpu_timings, 50) * 1000, 3)
+    result["queries"] = counter.count
+    result["response_bytes"] = len(response.get_data())
+
+    # Measured separately as tracing memory slows everything down
+    tracemalloc.start()
+    client.get(path).get_data()
+    result["peak_memory_kib"] = round(
+        tracemalloc.get_traced_memory()[1] / 1024
+    )
+    tracemalloc.stop()
+    return result
+
+
+def benchmark_function(func, iterations):
+    timings = []
+    for _ in range(iterations):
+        start = perf_counter()
+        func()
+        timings.append(perf_counter() - start)
+    return summarise(timings)
+
+
+def benchmark_functions(main, h, user_id, iterations):
+    """Times the core calculations directly, outside of any request."""
+    with main.app.test_request_context():
+        user = main.User.query.get(user_id)
+        outgoings = user.outgoings
+        months = [
+            (
+                outgoing.start_month or date(2000, 1, 1),
+                outgoing.end_month or date(2050, 12, 31),
+            )
+            for outgoing in outgoings
+        ]
+        results = {
+            "total_outgoings": benchmark_function(
+                lambda: user.total_outgoings(month_offset=1), iterations
+            ),
+            "end_of_month_target_balance": benchmark_function(
+                lambda: main.AnnualExpense.end_of_month_target_balance(user),
+                iterations,
+            ),
+            "month_count": benchmark_function(
+                lambda: [h.month_count(start, end) for start, end in months],
+                iterations,
+            ),
+        }
+        main.db.session.remove()
+    return results
+
+
+def load_worker(role, username, ids, duration, barrier, results):
+    """Run in a separate process by the concurrency benchmark. Readers
+    request pages and writers add outgoings, as fast as possible for
+    duration seconds. Puts (role, timings, errors) on the results queue."""
+    import main
+
+    client = main.app.test_client()
+    client.post(
+        "/login-handler", data={"username": username, "password": PASSWORD}
+    )
+    barrier.wait()
+
+    timings = []
+    errors = 0
+    finish = perf_counter() + duration
+    while perf_counter() < finish:
+        start = perf_counter()
+        if role == "reader":
+            response = client.get(
+                CONCURRENT_READ_PATHS[
+                    len(timings) % len(CONCURRENT_READ_PATHS)
+                ]
+            )
+        else:
+            response = client.post(
+                "/new-outgoing-handler",
+                data={
+                    "name": f"Concurrent {len(timings)}",
+                    "value": "1.00",
+                    "account_id": ids["account_id"],
+                    "start_month": "",
+                    "end_month": "",
+                    "notes": "",
+                },
+            )
+        response.get_data()
+        timings.append(perf_counter() - start)
+        if response.status_code >= 500:
+            errors += 1
+    results.put((role, timings, errors))
+
+
+def benchmark_concurrency(main, username, ids, readers, writers, duration):
+    """Runs reader and writer processes against the same user at the same
+    time, as gunicorn workers would, and returns the throughput and latency
+    of each. Errors are typically "database is locked" failures."""
+    with main.app.app_context():
+        main.db.engine.dispose()  # Don't share connections with workers
+
+    barrier = multiprocessing.Barrier(readers + writers)
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(
+            target=load_worker,
+            args=(role, username, ids, duration, barrier, results),
+        )
+        for role in ["reader"] * readers + ["writer"] * writers
+    ]
+    for process in processes:
+        process.start()
+    worker_results = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    summary = {
+        "sqlite_profile": main.app.config["SQLITE_PROFILE"],
+        "readers": readers,
+        "writers": writers,
+        "duration_s": duration,
+    }
+    for role in ("reader", "writer"):
+        timings = [
+            timing
+            for worker_role, worker_timings, _ in worker_results
+            if worker_role == role
+            for timing in worker_timings
+        ]
+        if len(timings) == 0:
+            continue
+        summary[f"{role}s_stats"] = {
+            "requests": len(timings),
+            "per_second": round(len(timings) / duration, 1),
+            "errors": sum(
+                errors
+                for worker_role, _, errors in worker_results
+                if worker_role == role
+            ),
+            **summarise(timings),
+        }
+    return summary
+
+
+def compare(results, baseline, threshold):
+    """Returns a list of regressions in results compared to baseline. A
+    regression is an increase in the number of SQL statements or a p50
+    latency more than threshold times the baseline."""
+    regressions = []
+    for size, pages in results["pages"].items():
+        for endpoint, result in pages.items():
+            previous = baseline.get("pages", {}).get(size, {}).get(endpoint)
+            if previous is None or "p50_ms" not in previous:
+                continue
+            if "error" in result:
+                regressions.append(f"{size} {endpoint}: {result['status']}")
+                continue
+            if result["queries"] > previous["queries"]:
+                regressions.append(
+                    f"{size} {endpoint}: {result['queries']} queries "
+                    f"(was {previous['queries']})"
+                )
+            if result["p50_ms"] > previous["p50_ms"] * threshold:
+                regressions.append(
+                    f"{size} {endpoint}: p50 {result['p50_ms']} ms "
+                    f"(was {previous['p50_ms']} ms)"
+                )
+    for size, functions in results["functions"].items():
+        for name, result in functions.items():
+            previous = baseline.get("functions", {}).get(size, {}).get(name)
+            if (
+                previous is not None
+                and result["p50_ms"] > previous["p50_ms"] * threshold
+            ):
+                regressions.append(
+                    f"{size} {name}(): p50 {result['p50_ms']} ms "
+                    f"(was {previous['p50_ms']} ms)"
+                )
+    return regressions
+
+
+@click.command()
+@click.option(
+    "--sizes",
+    default=DEFAULT_SIZES,
+    show_default=True,
+    help="Comma separated numbers of outgoings per user.",
+)
+@click.option("--accounts", default=10, show_default=True)
+@click.option("--annual-expenses", default=24, show_default=True)
+@click.option(
+    "--iterations",
+    "-n",
+    default=20,
+    show_default=True,
+    help="Timed requests per page.",
+)
+@click.option("--seed", default=0, show_default=True)
+@click.option(
+    "--output", "-o", type=click.Path(dir_okay=False), help="Results file."
+)
+@click.option(
+    "--compare",
+    "baseline_path",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Previous results to check for regressions.",
+)
+@click.option(
+    "--threshold",
+    default=1.5,
+    show_default=True,
+    help="Slowdown factor treated as a regression.",
+)
+@click.option(
+    "--sqlite-profile",
+    type=click.Choice(["default", "production"]),
+    default="default",
+    show_default=True,
+)
+@click.option(
+    "--readers",
+    default=0,
+    show_default=True,
+    help="Reader processes for the concurrency benchmark, 0 to skip it.",
+)
+@click.option("--writers", default=1, show_default=True)
+@click.option(
+    "--duration",
+    default=5.0,
+    show_default=True,
+    help="Seconds to run the concurrency benchmark for.",
+)
+@click.option(
+    "--users",
+    "user_counts",
+    default="",
+    help="Comma separated numbers of users for the multi-user benchmark.",
+)
+@click.option(
+    "--user-outgoings",
+    default=100,
+    show_default=True,
+    help="Outgoings of each user in the multi-user benchmark.",
+)
+@click.option("--minify", is_flag=True, help="Minify HTML responses.")
+@click.option("--compress", is_flag=True, help="Gzip responses.")
+@click.option(
+    "--concurrent-reads",
+    default=0,
+    show_default=True,
+    help="Threads reading the dashboard figures at once, 0 to read them "
+    "one after another.",
+)
+@click.option(
+    "--query-latency-ms",
+    default=0.0,
+    show_default=True,
+    help="Milliseconds added to every SQL statement.",
+)
+@click.option(
+    "--database-url",
+    envvar="BENCHMARK_DATABASE_URL",
+    help="An empty database to use instead of a temporary SQLite database.",
+)
+def run(
+    sizes,
+    accounts,
+    annual_expenses,
+    iterations,
+    seed,
+    output,
+    baseline_path,
+    threshold,
+    sqlite_profile,
+    readers,
+    writers,
+    duration,
+    user_counts,
+    user_outgoings,
+    minify,
+    compress,
+    concurrent_reads,
+    query_latency_ms,
+    database_url,
+):
+    if database_url is None:
+        directory = tempfile.mkdtemp()
+        database_url = f"sqlite:///{directory}/benchmark.db"
+        temporary_database = True
+    else:
+        temporary_database = False
+    configure_environment(database_url)
+    os.environ["SQLITE_PROFILE"] = sqlite_profile
+    os.environ["MINIFY_HTML"] = str(minify).lower()
+    os.environ["COMPRESS_RESPONSES"] = str(compress).lower()
+    os.environ["CONCURRENT_READS"] = str(concurrent_reads)
+    if query_latency_ms > 0:
+        add_query_latency(query_latency_ms / 1000)
+
+    import helpers as h
+    import main
+    import passwords
+    from instrumentation import QueryCounter
+
+    with benchmark_database(main, temporary_database):
+        rng = random.Random(seed)
+        options = {"accounts": accounts, "annual_expenses": annual_expenses}
+        results = {
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "database": database_url.split(":")[0],
+            "sqlite_profile": sqlite_profile,
+            "minify_html": minify,
+            "compress_responses": compress,
+            "concurrent_reads": concurrent_reads,
+            "query_latency_ms": query_latency_ms,
+            "iterations": iterations,
+            "pages": {},
+            "functions": {},
+        }
+
+        for size in [int(size) for size in sizes.split(",")]:
+            click.echo(f"{size} outgoings", err=True)
+            with main.app.app_context():
+                ids = create_user(
+                    main, passwords, f"benchmark-{size}", size, options, rng
+                )
+
+            client = main.app.test_client()
+            # As sent by browsers, so response_bytes are the bytes on the wire
+            client.environ_base["HTTP_ACCEPT_ENCODING"] = "gzip, deflate, br"
+            client.post(
+                "/login-handler",
+                data={"username": f"benchmark-{size}", "password": PASSWORD},
+            )
+            pages = {}
+            for endpoint, path in benchmarked_pages(main.app, ids):
+                main.summary_cache.clear()
+                pages[endpoint] = benchmark_page(
+                    client, path, iterations, QueryCounter
+                )
+                click.echo(f"  {endpoint:30} {pages[endpoint]}", err=True)
+            results["pages"][str(size)] = pages
+            results["functions"][str(size)] = benchmark_functions(
+                main, h, ids["user_id"], iterations
+            )
+
+        if readers > 0:
+            click.echo(
+                f"{readers} readers and {writers} writers for {duration}s",
+                err=True,
+            )
+            results["concurrency"] = benchmark_concurrency(
+                main, f"benchmark-{size}", ids, readers, writers, duration
+            )
+            click.echo(f"  {results['concurrency']}", err=True)
+
+        if user_counts:
+            results["users"] = benchmark_user_counts(
+                main,
+                passwords,
+                QueryCounter,
+                [int(user_count) for user_count in user_counts.split(",")],
+                user_outgoings,
+                options,
+                iterations,
+                rng,
+            )
+            user_results = list(results["users"].items())
+            fewest_users, fewest = user_results[0]
+            most_users, most = user_results[-1]
+            click.echo(
+                f"p50 with {fewest_users} and {most_users} users", err=True
+            )
+            for endpoint, result in most.items():
+                if "p50_ms" in result:
+                    click.echo(
+                        f"  {endpoint:30} {fewest[endpoint]['p50_ms']} ms, "
+                        f"{result['p50_ms']} ms",
+                        err=True,
+                    )
+
+    document = json.dumps(results, indent=2)
+    if output is None:
+        click.echo(document)
+    else:
+        with open(output, "w") as file:
+            file.write(document + "\n")
+
+    if baseline_path is not None:
+        with open(baseline_path) as file:
+            regressions = compare(results, json.load(file), threshold)
+        for regression in regressions:
+            click.echo(f"Regression: {regression}", err=True)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    run()
@@ -1,19 +1,41 @@
 import click
 
-from helpers import hash
-from main import PASSWORD_SALT, User, db
+import passwords
+import transfer
+from main import (
+    AnnualExpense,
+    MonthlySnapshot,
+    User,
+    app,
+    db,
+    export_rows,
+    import_rows,
+    upgrade_database,
+)
+
+
+def get_user(username):
+    """Returns the user with the given username, raising a ClickException if
+    there isn't one."""
+    user = User.query.filter_by(username=username.lower()).first()
+    if user is None:
+        raise click.ClickException(f"User '{username}' not found.")
+    return user
 
 
 @click.group()
-def cli():
-    pass
+@click.pass_context
+def cli(ctx):
+    ctx.with_resource(app.app_context())
 
 
 @click.command()
 @click.option("--username", "-u")
 @click.option("--password", "-p")
 def add_user(username, password):
-    password = hash(password, salt=PASSWORD_SALT)
+    # Often the first command run against a new database
+    upgrade_database()
+    password = passwords.hash_password(password)
     db.session.add(User(username=username, password=password))
     db.session.commit()
 
@@ -32,13 +54,151 @@ def unlock_user(username):
 @click.option("--password", "-p")
 def change_password(username, password):
     user = User.query.filter_by(username=username).first()
-    user.password = hash(password, salt=PASSWORD_SALT)
+    user.password = passwords.hash_password(password)
     db.session.commit()
 
 
+@click.command(name="import")
+@click.option("--username", "-u", required=True)
+@click.option(
+    "--file",
+    "-f",
+    "path",
+    type=click.Path(exists=True, dir_okay=False),
+    required=True,
+)
+@click.option("--format", "file_format", type=click.Choice(transfer.FORMATS))
+def import_file(username, path, file_format):
+    user = get_user(username)
+    if file_format is None:
+        try:
+            file_format = transfer.format_from_filename(path)
+        except ValueError as e:
+            raise click.ClickException(f"{e} Use --format to set it.")
+
+    with open(path, encoding="utf-8-sig", newline="") as file:
+        try:
+            accounts, outgoings, annual_expenses = import_rows(
+                user, transfer.read_rows(file, file_format)
+            )
+        except transfer.InvalidImport as e:
+            raise click.ClickException(str(e))
+
+    click.echo(
+        f"Imported {accounts} account(s), {outgoings} outgoing(s) and "
+        f"{annual_expenses} annual expense(s)."
+    )
+
+
+@click.command(name="export")
+@click.option("--username", "-u", help="Export a single user.")
+@click.option(
+    "--format",
+    "file_format",
+    type=click.Choice(transfer.FORMATS),
+    default="csv",
+    show_default=True,
+)
+@click.option(
+    "--output", "-o", type=click.File("w", encoding="utf-8"), default="-"
+)
+def export_file(username, file_format, output):
+    if username is None:
+        user_id = None
+        fields = ["username"] + transfer.EXPORT_FIELDS
+    else:
+        user_id = get_user(username).id
+        fields = transfer.EXPORT_FIELDS
+
+    for chunk in transfer.write_rows(
+        export_rows(user_id), file_format, fields
+    ):
+        output.write(chunk)
+
+
+@click.command()
+@click.option(
+    "--algorithm",
+    type=click.Choice(list(passwords.HASHERS)),
+    default=passwords.DEFAULT_HASHER,
+    show_default=True,
+)
+@click.option(
+    "--target-ms",
+    type=float,
+    default=100,
+    show_default=True,
+    help="The target time to verify a password.",
+)
+@click.option(
+    "--max-memory-mib",
+    type=int,
+    default=64,
+    show_default=True,
+    help="The most memory a single scrypt hash may use.",
+)
+def calibrate_passwords(algorithm, target_ms, max_memory_mib):
+    """Benchmarks password hashing on this host and prints the environment
+    variables to set to hash new passwords in around --target-ms."""
+    hasher, milliseconds = passwords.calibrate(
+        algorithm, target_ms, max_memory_mib=max_memory_mib
+    )
+    click.echo(f"# {hasher.parameters} takes {milliseconds:.0f} ms")
+    for name, value in hasher.environment().items():
+        click.echo(f"{name}={value}")
+
+
+@click.command()
+@click.option(
+    "--rebuild", is_flag=True, help="Correct any totals that are wrong."
+)
+def check_annual_totals(rebuild):
+    """Checks each users stored annual expense total against the sum of
+    their annual expenses."""
+    mismatches = AnnualExpense.check_annual_totals(rebuild=rebuild)
+    for username, stored_total, actual_total in mismatches:
+        click.echo(
+            f"{username}: stored {stored_total:.2f}, actual "
+            f"{actual_total:.2f}{' (rebuilt)' if rebuild else ''}"
+        )
+    if len(mismatches) > 0 and not rebuild:
+        raise click.ClickException(
+            f"{len(mismatches)} annual expense total(s) are wrong, run with "
+            f"--rebuild to correct them."
+        )
+
+
+@click.command()
+def upgrade():
+    """Creates or upgrades the database. This is otherwise done when the app
+    starts."""
+    added_columns = upgrade_database()
+    for table_name, column_name in added_columns:
+        click.echo(f"Added column {table_name}.{column_name}")
+
+
+@click.command()
+@click.option(
+    "--replace",
+    is_flag=True,
+    help="Replace snapshots already taken this month.",
+)
+def snapshot(replace):
+    """Records this months figures for every user, for the Trends page. Run
+    this on the 1st of each month, e.g. from cron."""
+    taken = MonthlySnapshot.take_all(replace=replace)
+    click.echo(f"Took {taken} snapshot(s).")
+
+
 cli.add_command(add_user)
 cli.add_command(unlock_user)
 cli.add_command(change_password)
+cli.add_command(import_file)
+cli.add_command(export_file)
+cli.add_command(calibrate_passwords)
+cli.add_command(upgrade)
+cli.add_command(check_annual_totals)
+cli.add_command(snapshot)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+
+import pickle
+from collections import OrderedDict
+from datetime import date
+from threading import Lock
+
+
+class SummaryCache:
+    """A least recently used cache of calculated per-user figures.
+
+    Entries are stored against a user id and that users data version so any
+    change to the users data results in a cache miss, even if the change was
+    made by another process. Entries are also tied to the month in which they
+    were calculated as figures such as the current outgoings change when the
+    month rolls over.
+
+    The total size of the cache is capped at max_bytes (estimated from the
+    pickled size of each entry). Setting max_bytes to 0 disables the cache.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get_or_set(self, user_id, data_version, key, func):
+        """Returns the cached value for the given user and key, calling func()
+        to calculate and store it if there is no valid entry."""
+        if self.max_bytes <= 0:
+            return func()
+
+        entry_key = (user_id, key)
+        stamp = (data_version, self._current_month())
+
+        with self._lock:
+            entry = self._entries.get(entry_key)
+            if entry is not None and entry[0] == stamp:
+                self._entries.move_to_end(entry_key)
+                return entry[2]
+
+        value = func()
+        size = len(pickle.dumps(value))
+
+        with self._lock:
+            self._discard(entry_key)
+            if size <= self.max_bytes:
+                self._entries[entry_key] = (stamp, size, value)
+                self.size += size
+                while self.size > self.max_bytes:
+                    self._discard(next(iter(self._entries)))
+
+        return value
+
+    def invalidate(self, user_id):
+        """Removes all of the cached entries for a user."""
+        with self._lock:
+            for entry_key in [
+                entry_key
+                for entry_key in self._entries
+                if entry_key[0] == user_id
+            ]:
+                self._discard(entry_key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _discard(self, entry_key):
+        entry = self._entries.pop(entry_key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    @staticmethod
+    def _current_month():
+        today = date.today()
+        return today.year, today.month
@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+
+import gzip
+import re
+
+from flask import current_app, request
+
+# Content types worth compressing
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/json",
+    "application/x-ndjson",
+    "application/javascript",
+)
+
+# Matches, in order of preference, elements whose content must be kept as it
+# is, tags (kept as they are as attribute values such as tooltips may contain
+# meaningful whitespace) and runs of whitespace between them.
+_HTML_TOKENS = re.compile(
+    r"<(pre|textarea|script|style)\b.*?</\1\s*>"
+    r"|<(?:[^>\"']|\"[^\"]*\"|'[^']*')*>"
+    r"|\s{2,}",
+    re.IGNORECASE | re.DOTALL,
+)
+
+
+def _minify_token(match):
+    token = match.group(0)
+    if token[0] == "<":
+        return token
+    return "\n" if "\n" in token else " "
+
+
+def minify_html(html):
+    """Returns the HTML with each run of whitespace between and within text
+    replaced by a single space or new line, which browsers display in the
+    same way. The contents of tags and of pre, textarea, script and style
+    elements are left as they are."""
+    return _HTML_TOKENS.sub(_minify_token, html)
+
+
+class ResponseCompression:
+    """Minifies HTML responses when the MINIFY_HTML config option is set
+    and gzips responses of at least COMPRESS_MIN_BYTES at COMPRESS_LEVEL when
+    COMPRESS_RESPONSES is set. Streamed responses and files are left as they
+    are, as are responses that are already compressed (see assets.py)."""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.after_request(self._process_response)
+
+    def _process_response(self, response):
+        if (
+            response.status_code != 200
+            or response.direct_passthrough
+            or response.is_streamed
+            or "Content-Encoding" in response.headers
+        ):
+            return response
+        config = current_app.config
+
+        if config["MINIFY_HTML"] and response.mimetype == "text/html":
+            response.set_data(minify_html(response.get_data(as_text=True)))
+
+        if config["COMPRESS_RESPONSES"] and response.mimetype.startswith(
+            COMPRESSIBLE_TYPES
+        ):
+            response.vary.add("Accept-Encoding")
+            if (
+                request.accept_encodings["gzip"] > 0
+                and response.content_length >= config["COMPRESS_MIN_BYTES"]
+            ):
+                response.set_data(
+                    gzip.compress(
+                        response.get_data(),
+                        config["COMPRESS_LEVEL"],
+                        mtime=0,
+                    )
+                )
+                response.content_encoding = "gzip"
+                # The compressed body is no longer byte for byte the same
+                # as the one the ETag was created for
+                etag, weak = response.get_etag()
+                if etag is not None and not weak:
+                    response.set_etag(etag, weak=True)
+
+        return response
@@ -0,0 +1,158 @@
+#!/usr/bin/python3
+
+import numpy as np
+
+import helpers as h
+
+# Used in place of a missing start or end month so that undated outgoings
+# fall within every forecast month.
+NO_START = np.iinfo(np.int64).min
+NO_END = np.iinfo(np.int64).max
+
+
+class Forecast:
+    """A month by month projection of a users outgoings, annual expenses and
+    salary. Every figure is a NumPy array with one item per forecast month.
+    """
+
+    def __init__(
+        self,
+        month_indexes,
+        accounts,
+        account_outgoings,
+        annual_expenses,
+        annual_expense_saving,
+        annual_expense_opening_balance,
+        salary,
+    ):
+        self.month_indexes = month_indexes
+        self.accounts = accounts
+        self.account_outgoings = account_outgoings
+        self.total_outgoings = account_outgoings.sum(axis=0)
+        self.annual_expenses = annual_expenses
+        self.annual_expense_balance = (
+            annual_expense_opening_balance
+            + np.cumsum(annual_expense_saving - annual_expenses)
+        )
+        self.salary = salary
+        self.after_outgoings = salary - self.total_outgoings
+        self.cumulative_after_outgoings = np.cumsum(self.after_outgoings)
+
+    @property
+    def months(self):
+        return [
+            h.month_index_to_date(month_index)
+            for month_index in self.month_indexes
+        ]
+
+    def rows(self):
+        """Yields a tuple of (month, total outgoings, annual expenses, salary,
+        after outgoings, cumulative after outgoings, annual expense balance)
+        for each forecast month."""
+        yield from zip(
+            self.months,
+            self.total_outgoings.tolist(),
+            self.annual_expenses.tolist(),
+            self.salary.tolist(),
+            self.after_outgoings.tolist(),
+            self.cumulative_after_outgoings.tolist(),
+            self.annual_expense_balance.tolist(),
+        )
+
+    def to_dict(self):
+        def rounded(array):
+            return np.round(array, 2).tolist()
+
+        return {
+            "months": [h.date_to_month_input(month) for month in self.months],
+            "accounts": [
+                {
+                    "id": account_id,
+                    "name": name,
+                    "outgoings": rounded(self.account_outgoings[position]),
+                }
+                for position, (account_id, name) in enumerate(self.accounts)
+            ],
+            "total_outgoings": rounded(self.total_outgoings),
+            "annual_expenses": rounded(self.annual_expenses),
+            "annual_expense_balance": rounded(self.annual_expense_balance),
+            "salary": rounded(self.salary),
+            "after_outgoings": rounded(self.after_outgoings),
+            "cumulative_after_outgoings": rounded(
+                self.cumulative_after_outgoings
+            ),
+        }
+
+
+def build_forecast(
+    first_month_index,
+    months,
+    accounts,
+    outgoings,
+    annual_expense_monthly_totals,
+    annual_expense_opening_balance=0,
+    monthly_salary=0,
+):
+    """Projects a users finances for the given number of months starting at
+    first_month_index (see helpers.month_index).
+
+    accounts is a list of (id, name) tuples and outgoings a list of
+    (account id, value, start month index, end month index) tuples where the
+    start and end month indexes can be None. annual_expense_monthly_totals is
+    a list of 12 totals, January first.
+
+    Rather than checking each outgoing against each month, a boolean interval
+    mask of outgoings by months is built in one step and the values summed per
+    account with a single matrix multiplication.
+    """
+    month_indexes = np.arange(
+        first_month_index, first_month_index + months, dtype=np.int64
+    )
+
+    account_positions = {
+        account_id: position
+        for position, (account_id, _) in enumerate(accounts)
+    }
+    outgoings = [
+        outgoing for outgoing in outgoings if outgoing[0] in account_positions
+    ]
+    positions = np.array(
+        [account_positions[outgoing[0]] for outgoing in outgoings],
+        dtype=np.int64,
+    )
+    values = np.array([outgoing[1] for outgoing in outgoings], dtype=float)
+    starts = np.array(
+        [
+            NO_START if outgoing[2] is None else outgoing[2]
+            for outgoing in outgoings
+        ],
+        dtype=np.int64,
+    )
+    ends = np.array(
+        [
+            NO_END if outgoing[3] is None else outgoing[3]
+            for outgoing in outgoings
+        ],
+        dtype=np.int64,
+    )
+
+    active = (starts[:, None] <= month_indexes[None, :]) & (
+        ends[:, None] >= month_indexes[None, :]
+    )
+    account_membership = (
+        positions[None, :] == np.arange(len(accounts))[:, None]
+    ).astype(float)
+    account_outgoings = account_membership @ (active * values[:, None])
+
+    monthly_totals = np.array(annual_expense_monthly_totals, dtype=float)
+    annual_expenses = monthly_totals[month_indexes % 12]
+
+    return Forecast(
+        month_indexes,
+        accounts,
+        account_outgoings,
+        annual_expenses,
+        monthly_totals.sum() / 12,
+        float(annual_expense_opening_balance),
+        np.full(months, float(monthly_salary or 0)),
+    )
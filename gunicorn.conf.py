@@ -0,0 +1,6 @@
+def on_starting(server):
+    """Upgrades the database once in the gunicorn master process before any
+    workers are started, rather than in every worker."""
+    import main
+
+    main.init_database(main.app)
@@ -59,24 +59,29 @@ def date_to_month_input(date_obj):
         return date_obj.strftime("%Y-%m")
 
 
-def month_count(start_date, end_date):
-    count = 0
-    one_month = relativedelta(months=1)
+def month_index(date_obj):
+    """Returns the number of months since year 0 so that months can be
+    compared and subtracted as integers."""
+    return date_obj.year * 12 + date_obj.month - 1
+
+
+def month_index_to_date(index):
+    """Returns the first day of the month for the given month index."""
+    return date(int(index) // 12, int(index) % 12 + 1, 1)
+
 
+def month_count(start_date, end_date):
+    """Returns the number of months from start_date to end_date inclusive."""
     if start_date > end_date:
         return 0
 
-    while True:
-        count += 1
-        if (
-            start_date.year == end_date.year
-            and start_date.month == end_date.month
-        ):
-            break
-        else:
-            start_date += one_month
+    return month_index(end_date) - month_index(start_date) + 1
+
 
-    return count
+def money(value):
+    """Returns a monetary value as a float rounded to 2 decimal places, e.g.
+    for JSON output."""
+    return round(float(value), 2)
 
 
 def checkbox_to_boolean(value):
@@ -0,0 +1,280 @@
+#!/usr/bin/python3
+
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock, local
+from time import perf_counter
+
+from flask import Response, current_app, g, request
+from flask.signals import before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_local = local()
+# Counters may be shared with other threads, see count_queries_in_thread
+_counter_lock = Lock()
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+# Upper bounds, in seconds, of the request duration histogram buckets.
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class QueryCounter:
+    """A context manager that counts the SQL statements executed by the
+    current thread while it is active, and the total time spent executing
+    them in seconds."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __enter__(self):
+        if not hasattr(_local, "counters"):
+            _local.counters = []
+        _local.counters.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _local.counters.remove(self)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    with _counter_lock:
+        for counter in getattr(_local, "counters", []):
+            counter.count += 1
+    context._query_started = perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def time_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed = perf_counter() - getattr(context, "_query_started", 0.0)
+    with _counter_lock:
+        for counter in getattr(_local, "counters", []):
+            counter.seconds += elapsed
+
+
+def count_queries_in_thread(func):
+    """Wraps func so that the SQL statements it executes are also counted by
+    the QueryCounters active in the calling thread when it is run in another
+    thread, e.g. by an executor. The SQL time of statements run at the same
+    time is added together, so can exceed the wall time."""
+    counters = list(getattr(_local, "counters", []))
+
+    @wraps(func)
+    def wrapped_func(*args, **kwargs):
+        previous_counters = getattr(_local, "counters", [])
+        _local.counters = previous_counters + counters
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.counters = previous_counters
+
+    return wrapped_func
+
+
+@contextmanager
+def assert_query_budget(budget, name="block"):
+    """Raises QueryBudgetExceeded if more than budget SQL statements are
+    executed within the with block."""
+    with QueryCounter() as counter:
+        yield counter
+    if counter.count > budget:
+        raise QueryBudgetExceeded(
+            f"{name} executed {counter.count} queries " f"(budget {budget})"
+        )
+
+
+def query_budget(budget):
+    """A decorator declaring the maximum number of SQL statements a route
+    should execute. The budget is only enforced when the
+    ENFORCE_QUERY_BUDGETS config option is set, e.g. when testing.
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapped_func(*args, **kwargs):
+            if not current_app.config.get("ENFORCE_QUERY_BUDGETS"):
+                return func(*args, **kwargs)
+            with assert_query_budget(budget, name=func.__name__):
+                return func(*args, **kwargs)
+
+        wrapped_func.query_budget = budget
+        return wrapped_func
+
+    return decorator
+
+
+class RouteMetrics:
+    """Totals of the requests made to a single route."""
+
+    def __init__(self):
+        self.requests = defaultdict(int)  # By response status code
+        self.buckets = [0] * len(DURATION_BUCKETS)
+        self.seconds = 0.0
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.template_seconds = 0.0
+
+    @property
+    def count(self):
+        return sum(self.requests.values())
+
+    def record(
+        self, status, seconds, queries, query_seconds, template_seconds
+    ):
+        self.requests[status] += 1
+        self.seconds += seconds
+        self.queries += queries
+        self.query_seconds += query_seconds
+        self.template_seconds += template_seconds
+        for position, bucket in enumerate(DURATION_BUCKETS):
+            if seconds <= bucket:
+                self.buckets[position] += 1
+
+
+class Metrics:
+    """Records the wall time, number of SQL statements, SQL time and template
+    render time of every request by route (Flask endpoint) and exposes them
+    in the Prometheus text format at /metrics.
+
+    Metrics are held in the memory of each process, so when running several
+    workers each scrape reflects only the worker that served it. Setting
+    server_timing adds a Server-Timing header to each response so the same
+    figures can be seen in the browser's developer tools.
+    """
+
+    def __init__(self, app=None, server_timing=False, endpoint=True):
+        self.server_timing = server_timing
+        self.routes = defaultdict(RouteMetrics)
+        self._lock = Lock()
+        if app is not None:
+            self.init_app(app, endpoint=endpoint)
+
+    def init_app(self, app, endpoint=True):
+        app.before_request(self._start_request)
+        app.after_request(self._end_request)
+        app.teardown_request(self._teardown_request)
+        before_render_template.connect(self._start_template, app)
+        template_rendered.connect(self._end_template, app)
+        if endpoint:
+            app.add_url_rule("/metrics", "metrics", self.metrics_response)
+
+    def metrics_response(self):
+        return Response(self.render(), mimetype="text/plain; version=0.0.4")
+
+    def render(self):
+        """Returns the recorded metrics in the Prometheus text format."""
+        with self._lock:
+            routes = sorted(self.routes.items())
+            lines = [
+                "# HELP bluesheet_requests_total Requests by route and "
+                "status.",
+                "# TYPE bluesheet_requests_total counter",
+            ]
+            for route, metrics in routes:
+                for status, count in sorted(metrics.requests.items()):
+                    lines.append(
+                        f'bluesheet_requests_total{{route="{route}",'
+                        f'status="{status}"}} {count}'
+                    )
+
+            lines += [
+                "# HELP bluesheet_request_duration_seconds Request wall "
+                "time.",
+                "# TYPE bluesheet_request_duration_seconds histogram",
+            ]
+            for route, metrics in routes:
+                label = f'route="{route}"'
+                for bucket, count in zip(DURATION_BUCKETS, metrics.buckets):
+                    lines.append(
+                        f"bluesheet_request_duration_seconds_bucket"
+                        f'{{{label},le="{bucket}"}} {count}'
+                    )
+                lines += [
+                    f"bluesheet_request_duration_seconds_bucket"
+                    f'{{{label},le="+Inf"}} {metrics.count}',
+                    f"bluesheet_request_duration_seconds_sum{{{label}}} "
+                    f"{metrics.seconds:.6f}",
+                    f"bluesheet_request_duration_seconds_count{{{label}}} "
+                    f"{metrics.count}",
+                ]
+
+            for name, attribute, description in (
+                ("sql_queries_total", "queries", "SQL statements executed"),
+                ("sql_seconds_total", "query_seconds", "Time spent in SQL"),
+                (
+                    "template_seconds_total",
+                    "template_seconds",
+                    "Time spent rendering templates",
+                ),
+            ):
+                lines += [
+                    f"# HELP bluesheet_{name} {description} by route.",
+                    f"# TYPE bluesheet_{name} counter",
+                ]
+                for route, metrics in routes:
+                    lines.append(
+                        f'bluesheet_{name}{{route="{route}"}} '
+                        f"{getattr(metrics, attribute):g}"
+                    )
+
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self.routes.clear()
+
+    def _start_request(self):
+        g._metrics_queries = QueryCounter().__enter__()
+        g._metrics_template_seconds = 0.0
+        g._metrics_started = perf_counter()
+
+    def _end_request(self, response):
+        if "_metrics_started" not in g:
+            return response
+
+        seconds = perf_counter() - g._metrics_started
+        queries = g._metrics_queries
+        template_seconds = g._metrics_template_seconds
+        with self._lock:
+            self.routes[request.endpoint or "unknown"].record(
+                response.status_code,
+                seconds,
+                queries.count,
+                queries.seconds,
+                template_seconds,
+            )
+
+        if self.server_timing:
+            response.headers["Server-Timing"] = ", ".join(
+                [
+                    f"app;dur={seconds * 1000:.1f}",
+                    f'sql;dur={queries.seconds * 1000:.1f};desc="'
+                    f'{queries.count} queries"',
+                    f"template;dur={template_seconds * 1000:.1f}",
+                ]
+            )
+        return response
+
+    def _teardown_request(self, exception):
+        queries = g.pop("_metrics_queries", None)
+        if queries is not None:
+            queries.__exit__(None, None, None)
+
+    def _start_template(self, app, template, context):
+        g._metrics_template_started = perf_counter()
+
+    def _end_template(self, app, template, context):
+        started = g.pop("_metrics_template_started", None)
+        if started is not None:
+            g._metrics_template_seconds = (
+                g.get("_metrics_template_seconds", 0.0)
+                + perf_counter()
+                - started
+            )
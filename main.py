@@ -1,48 +1,97 @@
 #!/usr/bin/python3
 
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime, timedelta
+from decimal import Decimal
 from functools import wraps
+from itertools import groupby
+from json import dumps, loads
 from os import environ
+from threading import Lock
 
-from dateutil.relativedelta import relativedelta
 from flask import (
     Flask,
+    Response,
+    current_app,
+    g,
+    jsonify,
     redirect,
     render_template,
     request,
     session,
+    stream_with_context,
     url_for,
 )
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.schema import CreateColumn
+from werkzeug.local import LocalProxy
 
 import helpers as h
-
-SESSION_KEY = environ.get("SESSION_KEY")
-if SESSION_KEY is None:
-    print("Environment Variable SESSION_KEY not set!")
-    exit(1)
-
-PASSWORD_SALT = environ.get("PASSWORD_SALT")
-if PASSWORD_SALT is None:
-    print("Environment Variable PASSWORD_SALT not set!")
-    exit(1)
+import passwords
+import sessions
+import transfer
+from assets import StaticAssets
+from cache import SummaryCache
+from compression import ResponseCompression
+from instrumentation import Metrics, count_queries_in_thread, query_budget
 
 LOGIN_TIMEOUT_MINUTES = 30
+# The last activity time is only updated when it is older than this, so that
+# most requests leave the session unmodified and it isn't saved again.
+LAST_ACTIVITY_WRITE_SECONDS = 60
 MAX_FAILED_LOGIN_ATTEMPTS = 3
+# Stored month indexes (see helpers.month_index) for outgoings without a
+# start or end month, so that date window queries can use range conditions.
+NO_START_MONTH_INDEX = 0
+NO_END_MONTH_INDEX = 9999 * 12 + 11
+EXPORT_BATCH_SIZE = 500
+DEFAULT_FORECAST_MONTHS = 24
+MAX_FORECAST_MONTHS = 600
+SESSION_STORES = ("cookie", "memory", "database")
+SQLITE_PROFILES = ("default", "production")
+# Set on every connection by the "production" SQLite profile. WAL lets
+# readers continue while a write is in progress and, with it, NORMAL
+# synchronous is still safe from corruption.
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,  # Milliseconds to wait for a lock
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -20000,  # Negative values are in KiB
+    "temp_store": "MEMORY",
+}
+
+db = SQLAlchemy()
+summary_cache = SummaryCache(0)
+metrics = Metrics()
+static_assets = StaticAssets()
+response_compression = ResponseCompression()
+
+# Routes are collected here and added to the app by create_app
+routes = []
+
+
+def route(rule, **options):
+    """A decorator registering a route in the same way as app.route."""
+
+    def decorator(func):
+        routes.append((rule, func, options))
+        return func
+
+    return decorator
 
-app = Flask(__name__)
-app.secret_key = SESSION_KEY
-app.config["SQLALCHEMY_DATABASE_URI"] = environ.get(
-    "DATABASE_URL", "sqlite:///database.db"
-)
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-db = SQLAlchemy(app)
 
-# Define "permanent" as 1 year and not the default 31 days
-app.permanent_session_lifetime = timedelta(days=365)
+# region Database
+def comparison_month_index(month_offset=0):
+    """The month index (see helpers.month_index) of the current month plus
+    month_offset months."""
+    return h.month_index(date.today()) + month_offset
 
 
-# region Database
 class User(db.Model):
     __tablename__ = "user"
 
@@ -51,6 +100,15 @@ class User(db.Model):
     password = db.Column(db.String, nullable=False)
     failed_login_attempts = db.Column(db.Integer, nullable=False)
     locked = db.Column(db.Boolean, nullable=False)
+    # Incremented whenever any of the users data changes.
+    data_version = db.Column(
+        db.Integer, nullable=False, default=0, server_default="0"
+    )
+    # The total value of the users annual expenses, adjusted as they are
+    # added, changed and removed (see adjust_annual_expense_totals).
+    annual_expense_total = db.Column(
+        db.Numeric, nullable=False, default=0, server_default="0"
+    )
     configuration = db.relationship(
         "Configuration", backref="user", uselist=False, lazy=True
     )
@@ -65,16 +123,25 @@ class User(db.Model):
         self.password = password
         self.failed_login_attempts = 0
         self.locked = False
+        self.data_version = 0
+        self.annual_expense_total = 0
 
     @classmethod
     def login(cls, username, password, remember, session):
         user = cls.query.filter_by(username=username.lower()).first()
 
-        if user is None:
-            return False, "Login failed, please try again."
-        elif user.locked:
+        if user is None or user.locked:
+            # Hash the password anyway so that these take as long as a
+            # failed login for an existing user
+            passwords.verify_password(password, passwords.DUMMY_HASH)
+            if user is None:
+                return False, "Login failed, please try again."
             return False, "Account locked, please contact your administrator."
-        elif h.hash(password, PASSWORD_SALT) != user.password:
+        elif not passwords.verify_password(
+            password,
+            user.password,
+            legacy_salt=current_app.config["PASSWORD_SALT"],
+        ):
             user.failed_login_attempts += 1
             if user.failed_login_attempts >= MAX_FAILED_LOGIN_ATTEMPTS:
                 user.locked = True
@@ -82,8 +149,13 @@ class User(db.Model):
             return False, "Login failed, please try again."
         else:
             user.failed_login_attempts = 0
+            # Upgrade legacy or outdated hashes now the password is known
+            if passwords.needs_rehash(user.password):
+                user.password = passwords.hash_password(password)
             db.session.commit()
 
+            # Start a new session, so that a new session id is issued
+            session.clear()
             # Stop the session from expiring when the browser closes
             session.permanent = True
 
@@ -104,29 +176,53 @@ class User(db.Model):
 
         @wraps(func)
         def wrapped_func(*args, **kwargs):
-            if "user_id" not in session:
-                return redirect(url_for("login"))
-            if "last_activity" not in session:
-                return redirect(url_for("login"))
-            if (
-                datetime.strptime(
-                    session["last_activity"], "%Y-%m-%d %H:%M:%S"
-                )
-                < (
-                    datetime.now()
-                    - relativedelta(minutes=LOGIN_TIMEOUT_MINUTES)
-                )
-                and session["remember"] is False
-            ):
-                return redirect(url_for("login"))
+            idle_seconds = cls.session_idle_seconds()
+            if idle_seconds is None:
+                return cls.login_response()
             else:
-                session["last_activity"] = datetime.now().strftime(
-                    "%Y-%m-%d %H:%M:%S"
-                )
+                if idle_seconds >= LAST_ACTIVITY_WRITE_SECONDS:
+                    session["last_activity"] = datetime.now().strftime(
+                        "%Y-%m-%d %H:%M:%S"
+                    )
                 return func(*args, **kwargs)
 
         return wrapped_func
 
+    @staticmethod
+    def session_idle_seconds():
+        """Returns the number of seconds since the logged in users last
+        activity, or None if no user is logged in or their login has timed
+        out."""
+        if "user_id" not in session:
+            return None
+        if "last_activity" not in session:
+            return None
+        idle_seconds = (
+            datetime.now()
+            - datetime.strptime(session["last_activity"], "%Y-%m-%d %H:%M:%S")
+        ).total_seconds()
+        if (
+            idle_seconds > LOGIN_TIMEOUT_MINUTES * 60
+            and session["remember"] is False
+        ):
+            return None
+        return idle_seconds
+
+    @staticmethod
+    def login_response():
+        """The response returned when login is required. API clients are given
+        a 401 rather than being redirected to the login page."""
+        if request.path.startswith("/api/"):
+            return jsonify(error="Login required."), 401
+        return redirect(url_for("login"))
+
+    @classmethod
+    def load(cls, user_id, *options):
+        """Returns the user with the given id, eagerly loading any related
+        data specified by the loader options so that pages can be rendered in
+        a fixed number of queries."""
+        return cls.query.options(*options).filter_by(id=user_id).first()
+
     def configuration_required(self):
         """Checks to see if the user has completed configuration and returns
         True if not. This assumes that if configuration exists it is complete.
@@ -135,11 +231,9 @@ class User(db.Model):
 
     def total_outgoings(self, month_offset=0):
         """The total value of all of the users monthly outgoings."""
-        total_outgoings = 0
-        for outgoing in self.outgoings:
-            if outgoing.is_current(month_offset=month_offset):
-                total_outgoings += outgoing.value
-        return total_outgoings
+        return Outgoing.current_total(
+            Outgoing.user_id == self.id, month_offset=month_offset
+        )
 
     def emergency_fund_target(self, month_offset=0):
         """The total outgoings excluding those excluded from the emergency fund."""
@@ -150,20 +244,173 @@ class User(db.Model):
         ):
             return 0
         return (
-            sum(
-                [
-                    outgoing.value
-                    for outgoing in self.outgoings
-                    if outgoing.is_current(month_offset=month_offset)
-                    and (
-                        outgoing.emergency_fund_excluded is False
-                        or outgoing.emergency_fund_excluded is None
-                    )
-                ]
+            Outgoing.current_total(
+                Outgoing.user_id == self.id,
+                Outgoing.emergency_fund_excluded.isnot(True),
+                month_offset=month_offset,
             )
             * self.configuration.emergency_fund_months
         )
 
+    def dashboard_summary(self, month_offset=0):
+        """Calculates all of the dashboard figures using a single grouped
+        query rather than walking the users outgoings once per figure."""
+        current = Outgoing.current_clause(month_offset=month_offset)
+        account_totals = (
+            db.session.query(
+                Account.id,
+                Account.name,
+                Account.notes,
+                db.func.coalesce(db.func.sum(Outgoing.value), 0).label(
+                    "total_outgoings"
+                ),
+                db.func.coalesce(
+                    db.func.sum(
+                        db.case(
+                            (Outgoing.emergency_fund_excluded.is_(True), 0),
+                            else_=Outgoing.value,
+                        )
+                    ),
+                    0,
+                ).label("emergency_fund_outgoings"),
+            )
+            .outerjoin(
+                Outgoing, db.and_(Outgoing.account_id == Account.id, current)
+            )
+            .filter(Account.user_id == self.id)
+            .group_by(Account.id, Account.name, Account.notes)
+            .all()
+        )
+        return DashboardSummary(self.configuration, account_totals)
+
+    def cached(self, key, func):
+        """Returns the result of func(), reusing a previously calculated
+        result for as long as the users data remains unchanged."""
+        return summary_cache.get_or_set(self.id, self.data_version, key, func)
+
+    def cached_dashboard_summary(self):
+        """The dashboard summary for next month, see dashboard_summary()."""
+        return self.cached(
+            ("dashboard_summary", 1),
+            lambda: self.dashboard_summary(month_offset=1),
+        )
+
+    def cached_end_of_month_target_balance(self):
+        return self.cached(
+            "end_of_month_target_balance",
+            lambda: AnnualExpense.end_of_month_target_balance(self),
+        )
+
+    def forecast(self, months, month_offset=1):
+        """Projects the users finances for the given number of months,
+        starting month_offset months from now."""
+        # Imported here as it loads numpy, which slows down the CLI commands
+        from forecast import build_forecast
+
+        accounts = (
+            db.session.query(Account.id, Account.name)
+            .filter(Account.user_id == self.id)
+            .order_by(db.func.lower(Account.name))
+            .all()
+        )
+        outgoings = db.session.query(
+            Outgoing.account_id,
+            Outgoing.value,
+            Outgoing.start_month_idx,
+            Outgoing.end_month_idx,
+        ).filter(Outgoing.user_id == self.id)
+        monthly_totals = AnnualExpense.monthly_totals(self)
+
+        if self.configuration is None:
+            monthly_salary = 0
+        else:
+            monthly_salary = (self.configuration.annual_net_salary or 0) / 12
+
+        return build_forecast(
+            comparison_month_index(month_offset),
+            months,
+            accounts,
+            outgoings,
+            monthly_totals,
+            annual_expense_opening_balance=(
+                AnnualExpense.end_of_month_target_balance(
+                    self, monthly_totals=monthly_totals
+                )
+            ),
+            monthly_salary=monthly_salary,
+        )
+
+
+class DashboardSummary:
+    """A precomputed set of dashboard figures. Only plain values are held so
+    that a summary can outlive the database session it was created in."""
+
+    def __init__(self, configuration, account_totals):
+        self.accounts = account_totals
+        self.total_outgoings = sum(
+            account.total_outgoings for account in account_totals
+        )
+
+        if configuration is None or not configuration.emergency_fund_months:
+            self.emergency_fund_months = 0
+            self.emergency_fund_target = 0
+        else:
+            self.emergency_fund_months = configuration.emergency_fund_months
+            self.emergency_fund_target = (
+                sum(
+                    account.emergency_fund_outgoings
+                    for account in account_totals
+                )
+                * configuration.emergency_fund_months
+            )
+
+        if configuration is None or not configuration.annual_net_salary:
+            self.net_monthly_salary = None
+            self.salary_after_outgoings = None
+        else:
+            self.net_monthly_salary = configuration.annual_net_salary / 12
+            self.salary_after_outgoings = (
+                self.net_monthly_salary - self.total_outgoings
+            )
+
+    def to_dict(self):
+        return {
+            "accounts": [
+                {
+                    "id": account.id,
+                    "name": account.name,
+                    "notes": account.notes,
+                    "total_outgoings": h.money(account.total_outgoings),
+                }
+                for account in self.accounts
+            ],
+            "total_outgoings": h.money(self.total_outgoings),
+            "emergency_fund_months": self.emergency_fund_months,
+            "emergency_fund_target": h.money(self.emergency_fund_target),
+            "net_monthly_salary": None
+            if self.net_monthly_salary is None
+            else h.money(self.net_monthly_salary),
+            "salary_after_outgoings": None
+            if self.salary_after_outgoings is None
+            else h.money(self.salary_after_outgoings),
+        }
+
+
+class UserOwnedMixin:
+    """Queries scoped to a single user's rows, for models with a user_id.
+    Routes use these rather than querying the model directly so that a user
+    can only ever reach their own data."""
+
+    @classmethod
+    def owned_by(cls, user_id):
+        return cls.query.filter(cls.user_id == user_id)
+
+    @classmethod
+    def get_owned(cls, user_id, id):
+        """Returns the users row with the given id, or aborts with a 404 if
+        it doesn't exist or belongs to another user."""
+        return cls.owned_by(user_id).filter(cls.id == id).first_or_404()
+
 
 class Configuration(db.Model):
     __tablename__ = "configuration"
@@ -191,7 +438,7 @@ class Configuration(db.Model):
         self.annual_net_salary = annual_net_salary
 
 
-class Account(db.Model):
+class Account(UserOwnedMixin, db.Model):
     __tablename__ = "account"
 
     id = db.Column(db.Integer, primary_key=True)
@@ -200,6 +447,8 @@ class Account(db.Model):
     notes = db.Column(db.String)
     outgoings = db.relationship("Outgoing", backref="account", lazy=True)
 
+    __table_args__ = (db.Index("ix_account_user_id_name", "user_id", "name"),)
+
     def __init__(self, user_id, name, notes=None):
         self.user_id = user_id
         self.name = name
@@ -207,20 +456,32 @@ class Account(db.Model):
 
     def total_outgoings(self, month_offset=0):
         """The total value of the accounts monthly outgoings."""
-        total_outgoings = 0
-        for outgoing in self.outgoings:
-            if outgoing.is_current(month_offset=month_offset):
-                total_outgoings = total_outgoings + outgoing.value
-        return total_outgoings
+        return Outgoing.current_total(
+            Outgoing.account_id == self.id, month_offset=month_offset
+        )
 
     def delete(self):
-        for outgoing in self.outgoings:
-            outgoing.delete()
-        db.session.delete(self)
-        db.session.commit()
+        """Deletes the account and all of its outgoings in a single
+        transaction."""
+        user_id, account_id = self.user_id, self.id
+        try:
+            Outgoing.delete_where(
+                user_id,
+                db.and_(
+                    Outgoing.user_id == user_id,
+                    Outgoing.account_id == account_id,
+                ),
+            )
+            Account.owned_by(user_id).filter(Account.id == account_id).delete(
+                synchronize_session=False
+            )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
 
 
-class Outgoing(db.Model):
+class Outgoing(UserOwnedMixin, db.Model):
     __tablename__ = "outgoing"
 
     id = db.Column(db.Integer, primary_key=True)
@@ -232,9 +493,34 @@ class Outgoing(db.Model):
     )
     start_month = db.Column(db.Date)
     end_month = db.Column(db.Date)
+    # Month indexes of start_month and end_month, set on insert and update.
+    start_month_idx = db.Column(
+        db.Integer,
+        nullable=False,
+        default=NO_START_MONTH_INDEX,
+        server_default=str(NO_START_MONTH_INDEX),
+    )
+    end_month_idx = db.Column(
+        db.Integer,
+        nullable=False,
+        default=NO_END_MONTH_INDEX,
+        server_default=str(NO_END_MONTH_INDEX),
+    )
     notes = db.Column(db.String)
     emergency_fund_excluded = db.Column(db.Boolean)
 
+    __table_args__ = (
+        db.Index("ix_outgoing_user_id_account_id", "user_id", "account_id"),
+        # Used when loading the outgoings of accounts
+        db.Index("ix_outgoing_account_id", "account_id"),
+        db.Index(
+            "ix_outgoing_user_id_month_idx",
+            "user_id",
+            "start_month_idx",
+            "end_month_idx",
+        ),
+    )
+
     def __init__(
         self,
         user_id,
@@ -281,23 +567,17 @@ class Outgoing(db.Model):
         if self.start_month is None:
             return False
 
-        comparison_date = date.today() + relativedelta(months=month_offset)
-
-        if self.start_month > comparison_date:
-            return True
-        else:
-            return False
+        return h.month_index(self.start_month) > comparison_month_index(
+            month_offset
+        )
 
     def is_historic(self, month_offset=0):
         if self.end_month is None:
             return False
 
-        comparison_date = date.today() + relativedelta(months=month_offset)
-
-        if self.end_month < comparison_date:
-            return True
-        else:
-            return False
+        return h.month_index(self.end_month) < comparison_month_index(
+            month_offset
+        )
 
     def is_current(self, month_offset=0):
         if self.is_historic(month_offset=month_offset) or self.is_future(
@@ -307,6 +587,39 @@ class Outgoing(db.Model):
         else:
             return True
 
+    @classmethod
+    def current_clause(cls, month_offset=0):
+        """The SQL equivalent of is_current() for use in query filters."""
+        month_index = comparison_month_index(month_offset)
+        return db.and_(
+            cls.start_month_idx <= month_index,
+            cls.end_month_idx >= month_index,
+        )
+
+    @classmethod
+    def current_total(cls, *criteria, month_offset=0):
+        """The total value of the outgoings matching the criteria that are
+        current in the month, summed by the database so that NUMERIC values
+        are added exactly where the database supports it."""
+        return (
+            db.session.query(db.func.coalesce(db.func.sum(cls.value), 0))
+            .filter(*criteria, cls.current_clause(month_offset=month_offset))
+            .scalar()
+        )
+
+    @staticmethod
+    def month_indexes(start_month, end_month):
+        """Returns the stored (start_month_idx, end_month_idx) values for the
+        given start and end months."""
+        return (
+            NO_START_MONTH_INDEX
+            if start_month is None
+            else h.month_index(start_month),
+            NO_END_MONTH_INDEX
+            if end_month is None
+            else h.month_index(end_month),
+        )
+
     @property
     def is_dated(self):
         if self.start_month is not None or self.end_month is not None:
@@ -326,8 +639,9 @@ class Outgoing(db.Model):
         if self.start_month is None or self.end_month is None:
             return 0  # Not desinged to be used without start and end dates
         else:
-            return h.month_count(
-                date.today() + relativedelta(months=1), self.end_month
+            return max(
+                h.month_index(self.end_month) - comparison_month_index(1) + 1,
+                0,
             )
 
     @property
@@ -349,12 +663,12 @@ class Outgoing(db.Model):
         if not self.is_dated:
             return ""
 
-        today = date.today()
+        this_month = comparison_month_index()
 
         # Start
         if self.start_month is None:
             start = ""
-        elif self.start_month > today:
+        elif h.month_index(self.start_month) > this_month:
             start = "Starts"
         else:
             start = "Started"
@@ -362,20 +676,22 @@ class Outgoing(db.Model):
         # End
         if self.end_month is None:
             end = ""
-        elif self.end_month >= today:
+        elif h.month_index(self.end_month) >= this_month:
             end = "Ends"
         else:
             end = "Ended"
 
         if self.start_month is not None and self.end_month is not None:
             # Start and End Months
+            months_paid = self.months_paid
+            months_paid_left = self.months_paid_left
             return "\n".join(
                 [
                     f"{start} {self.start_month_friendly}",
                     f"{end} {self.end_month_friendly}",
                     "",
-                    f"{self.months_paid} payment(s) overall totaling £{self.payments_total:,.2f}",
-                    f"{self.months_paid_left} payment(s) left totaling £{self.payments_left_total:,.2f}",
+                    f"{months_paid} payment(s) overall totaling £{self.value * months_paid:,.2f}",
+                    f"{months_paid_left} payment(s) left totaling £{self.value * months_paid_left:,.2f}",
                 ]
             )
         elif self.start_month is not None:
@@ -385,19 +701,119 @@ class Outgoing(db.Model):
             # End Month Only
             return f"{end} {self.end_month_friendly}"
 
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "account_id": self.account_id,
+            "name": self.name,
+            "value": h.money(self.value),
+            "start_month": self.start_month_input_string,
+            "end_month": self.end_month_input_string,
+            "notes": self.notes,
+            "emergency_fund_excluded": self.emergency_fund_excluded is True,
+            "is_current": self.is_current(),
+        }
+
     def delete(self):
-        # If this outgoing is used for annual expenses, unlink it first
-        user_configuration = Configuration.query.filter_by(
-            user_id=self.user_id
-        ).first()
-        if user_configuration.annual_expense_outgoing_id == self.id:
-            user_configuration.annual_expense_outgoing_id = None
+        Outgoing.bulk_delete(self.user_id, [self.id])
 
-        db.session.delete(self)
-        db.session.commit()
+    @classmethod
+    def owned_clause(cls, user_id, outgoing_ids):
+        return db.and_(cls.user_id == user_id, cls.id.in_(outgoing_ids))
+
+    @classmethod
+    def bulk_delete(cls, user_id, outgoing_ids):
+        """Deletes the given outgoings of a user in a single transaction.
+        Returns the number of outgoings deleted."""
+        try:
+            deleted = cls.delete_where(
+                user_id, cls.owned_clause(user_id, outgoing_ids)
+            )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return deleted
+
+    @classmethod
+    def delete_where(cls, user_id, selected):
+        """Deletes a users outgoings matching the selected clause with set
+        based statements, without committing. Returns the number of
+        outgoings deleted."""
+        # If any of the outgoings are used for annual expenses, unlink them
+        # first
+        Configuration.query.filter(
+            Configuration.user_id == user_id,
+            Configuration.annual_expense_outgoing_id.in_(
+                db.select(cls.id).where(selected)
+            ),
+        ).update(
+            {"annual_expense_outgoing_id": None}, synchronize_session=False
+        )
+        deleted = cls.query.filter(selected).delete(synchronize_session=False)
+        mark_users_changed(db.session, {user_id})
+        return deleted
+
+    @classmethod
+    def bulk_update(cls, user_id, outgoing_ids, **values):
+        """Sets the given column values on the given outgoings of a user in
+        a single statement. Returns the number of outgoings updated.
+
+        The outgoing linked to annual expenses is not given an end month as
+        its dates are managed automatically. Moving outgoings to an account
+        that does not belong to the user, or giving an outgoing an end month
+        before its start month, raises a ValueError.
+        """
+        selected = cls.owned_clause(user_id, outgoing_ids)
 
+        if "account_id" in values:
+            account = (
+                Account.owned_by(user_id)
+                .filter(Account.id == values["account_id"])
+                .first()
+            )
+            if account is None:
+                raise ValueError("Account not found.")
+
+        if "end_month" in values:
+            values["end_month_idx"] = cls.month_indexes(
+                None, values["end_month"]
+            )[1]
+            ends_before_start = (
+                cls.query.filter(
+                    selected, cls.start_month_idx > values["end_month_idx"]
+                )
+                .order_by(cls.name)
+                .first()
+            )
+            if ends_before_start is not None:
+                raise ValueError(
+                    f"The last month paid can't be before the start month of "
+                    f"{ends_before_start.name}."
+                )
+            selected = db.and_(
+                selected,
+                cls.id.notin_(
+                    db.select(Configuration.annual_expense_outgoing_id).where(
+                        Configuration.user_id == user_id,
+                        Configuration.annual_expense_outgoing_id.isnot(None),
+                    )
+                ),
+            )
 
-class AnnualExpense(db.Model):
+        try:
+            updated = cls.query.filter(selected).update(
+                values, synchronize_session=False
+            )
+            mark_users_changed(db.session, {user_id})
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return updated
+
+
+class AnnualExpense(UserOwnedMixin, db.Model):
     __tablename__ = "annual_expense"
 
     id = db.Column(db.Integer, primary_key=True)
@@ -407,6 +823,12 @@ class AnnualExpense(db.Model):
     value = db.Column(db.Numeric, nullable=False)
     notes = db.Column(db.String)
 
+    __table_args__ = (
+        db.Index(
+            "ix_annual_expense_user_id_month_paid", "user_id", "month_paid"
+        ),
+    )
+
     def __init__(self, user_id, month_paid, name, value, notes=None):
         self.user_id = user_id
         self.month_paid = month_paid
@@ -425,57 +847,95 @@ class AnnualExpense(db.Model):
         )
 
     @classmethod
-    def annual_total(cls, user):
-        annual_expenses = cls.query.filter_by(user_id=user.id)
+    def grouped_by_month(cls, user):
+        """Returns a list of (month number, annual expenses, subtotal) tuples
+        for each month in which the user pays annual expenses, ordered by
+        month and then name, along with the yearly total."""
+        annual_expenses = cls.owned_by(user.id).order_by(
+            cls.month_paid, db.func.lower(cls.name)
+        )
+
+        months = []
+        for month_paid, month_expenses in groupby(
+            annual_expenses,
+            key=lambda annual_expense: annual_expense.month_paid,
+        ):
+            month_expenses = list(month_expenses)
+            months.append(
+                (
+                    month_paid,
+                    month_expenses,
+                    sum(
+                        annual_expense.value
+                        for annual_expense in month_expenses
+                    ),
+                )
+            )
 
-        annual_total = 0
-        for annual_expense in annual_expenses:
-            annual_total = annual_total + annual_expense.value
+        return months, sum(subtotal for _, _, subtotal in months)
 
-        return annual_total
+    @classmethod
+    def annual_total(cls, user):
+        return user.annual_expense_total
 
     @classmethod
     def monthly_saving(cls, user):
         return cls.annual_total(user) / 12
 
     @classmethod
-    def end_of_month_target_balance(cls, user):
+    def monthly_totals(cls, user):
+        """Returns a list of 12 totals, one for each month of the year
+        (January first), of the users annual expenses paid in that month."""
+        monthly_totals = [0] * 12
+        for month_paid, total in (
+            db.session.query(cls.month_paid, db.func.sum(cls.value))
+            .filter(cls.user_id == user.id)
+            .group_by(cls.month_paid)
+        ):
+            monthly_totals[month_paid - 1] = total
+        return monthly_totals
+
+    @classmethod
+    def balance_trajectory(cls, user, monthly_totals=None):
         """Runs a year long simulation of annual expense savings and expenses
-        and if at any point the account balance goes into the negative that
-        negative amount is returned as a positive current target balance.
+        and returns a list of (month number, end of month balance) tuples
+        starting next month.
         """
-        monthly_saving = cls.monthly_saving(user)
-        current_month = h.current_month_num()
+        if monthly_totals is None:
+            monthly_totals = cls.monthly_totals(user)
+        monthly_saving = sum(monthly_totals) / 12
 
         # Start the simulation next month as the presumption is that this
         # month has already been saved and spent.
-        working_month = h.next_month(current_month)
-        ending_month = current_month
+        working_month = h.next_month(h.current_month_num())
 
+        # Each month the saving is added and that months expenses are paid
+        # out, so the balance is a running sum of the monthly differences.
         working_balance = 0
-        lowest_balance = 999999999  # Initialise
-
-        # Simulate a year.
-        while True:
-            # Add saving at the begining of the month.
-            working_balance = working_balance + monthly_saving
-
-            # Pay out the expenses throughout the month.
-            for annual_expense in cls.query.filter_by(
-                user_id=user.id, month_paid=working_month
-            ):
-                working_balance = working_balance - annual_expense.value
-
-            # If this is the lowest balance we've seen, record it.
-            if working_balance < lowest_balance:
-                lowest_balance = working_balance
+        trajectory = []
+        for _ in range(12):
+            working_balance = (
+                working_balance
+                + monthly_saving
+                - monthly_totals[working_month - 1]
+            )
+            trajectory.append((working_month, working_balance))
+            working_month = h.next_month(working_month)
 
-            if working_month == ending_month:
-                break
-            else:
-                working_month = h.next_month(working_month)
+        return trajectory
 
-        return -lowest_balance
+    @classmethod
+    def end_of_month_target_balance(cls, user, monthly_totals=None):
+        """Runs a year long simulation of annual expense savings and expenses
+        and if at any point the account balance goes into the negative that
+        negative amount is returned as a positive current target balance.
+        """
+        return -min(
+            balance
+            for _, balance in cls.balance_trajectory(
+                user, monthly_totals=monthly_totals
+            )
+        )
 
     @classmethod
     def update_user_annual_expense_outgoing(cls, user):
@@ -487,21 +947,578 @@ class AnnualExpense(db.Model):
             return
 
         else:
-            for outgoing in user.outgoings:
-                if outgoing.id == outgoing_id:
-                    outgoing.value = cls.monthly_saving(user)
-                    outgoing.start_month = None
-                    outgoing.end_month = None
+            outgoing = (
+                Outgoing.owned_by(user.id)
+                .filter(Outgoing.id == outgoing_id)
+                .first()
+            )
+            if outgoing is None:  # e.g. deleted
+                return
+            outgoing.value = cls.monthly_saving(user)
+            outgoing.start_month = None
+            outgoing.end_month = None
             db.session.commit()
             return
 
+    @classmethod
+    def check_annual_totals(cls, rebuild=False):
+        """Compares each users stored annual expense total with the sum of
+        their annual expenses and returns a list of (username, stored total,
+        actual total) tuples for those that differ. If rebuild is True the
+        stored totals and linked outgoings are corrected."""
+        actual_totals = (
+            db.select(db.func.coalesce(db.func.sum(cls.value), 0))
+            .where(cls.user_id == User.id)
+            .scalar_subquery()
+        )
+        mismatches = [
+            (user_id, username, stored_total, actual_total)
+            for user_id, username, stored_total, actual_total in (
+                db.session.query(
+                    User.id,
+                    User.username,
+                    User.annual_expense_total,
+                    actual_totals,
+                )
+            )
+            if abs(Decimal(stored_total) - Decimal(actual_total))
+            >= Decimal("0.005")
+        ]
+
+        if rebuild and len(mismatches) > 0:
+            db.session.query(User).filter(
+                User.id.in_([user_id for user_id, *_ in mismatches])
+            ).update(
+                {User.annual_expense_total: actual_totals},
+                synchronize_session=False,
+            )
+            mark_users_changed(
+                db.session, {user_id for user_id, *_ in mismatches}
+            )
+            db.session.commit()
+            for user_id, *_ in mismatches:
+                cls.update_user_annual_expense_outgoing(
+                    User.query.get(user_id)
+                )
+
+        return [
+            (username, stored_total, actual_total)
+            for _, username, stored_total, actual_total in mismatches
+        ]
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "month_paid": self.month_paid,
+            "name": self.name,
+            "value": h.money(self.value),
+            "notes": self.notes,
+        }
+
     def delete(self):
         db.session.delete(self)
         db.session.commit()
 
 
-db.create_all()
-db.session.commit()
+class MonthlySnapshot(db.Model):
+    """The figures for a user as they were in a given month, recorded once a
+    month so that trends can be shown without recalculating past months.
+    The accounts column holds the per account totals as JSON."""
+
+    __tablename__ = "monthly_snapshot"
+
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    month_idx = db.Column(db.Integer, primary_key=True)
+    total_outgoings = db.Column(db.Numeric, nullable=False)
+    emergency_fund_target = db.Column(db.Numeric, nullable=False)
+    annual_expense_total = db.Column(db.Numeric, nullable=False)
+    annual_expense_target_balance = db.Column(db.Numeric, nullable=False)
+    net_monthly_salary = db.Column(db.Numeric)
+    accounts = db.Column(db.Text, nullable=False)
+    created = db.Column(db.DateTime, nullable=False)
+
+    @classmethod
+    def take(cls, user, replace=False):
+        """Records the users figures for the current month, unless they have
+        already been recorded. Returns True if a snapshot was taken."""
+        month_idx = comparison_month_index()
+        existing = cls.query.get((user.id, month_idx))
+        if existing is not None:
+            if not replace:
+                return False
+            db.session.delete(existing)
+            db.session.flush()
+            # So that cached trends (e.g. by ETag) aren't used
+            mark_users_changed(db.session, {user.id})
+
+        summary = user.dashboard_summary()
+        db.session.add(
+            cls(
+                user_id=user.id,
+                month_idx=month_idx,
+                total_outgoings=summary.total_outgoings,
+                emergency_fund_target=summary.emergency_fund_target,
+                annual_expense_total=user.annual_expense_total,
+                annual_expense_target_balance=(
+                    AnnualExpense.end_of_month_target_balance(user)
+                ),
+                net_monthly_salary=summary.net_monthly_salary,
+                accounts=dumps(
+                    [
+                        {
+                            "id": account.id,
+                            "name": account.name,
+                            "total_outgoings": h.money(
+                                account.total_outgoings
+                            ),
+                        }
+                        for account in summary.accounts
+                    ]
+                ),
+                created=datetime.now(),
+            )
+        )
+        try:
+            db.session.commit()
+        except IntegrityError:  # Taken at the same time by another process
+            db.session.rollback()
+            return False
+        return True
+
+    @classmethod
+    def take_all(cls, replace=False):
+        """Takes the current months snapshot for every user. Returns the
+        number of snapshots taken."""
+        return sum(
+            cls.take(user, replace=replace)
+            for user in User.query.options(
+                db.joinedload(User.configuration)
+            ).all()
+        )
+
+    @classmethod
+    def for_user(cls, user_id):
+        """Returns all of a users snapshots, oldest first."""
+        return (
+            cls.query.filter_by(user_id=user_id).order_by(cls.month_idx).all()
+        )
+
+    @property
+    def month(self):
+        return h.month_index_to_date(self.month_idx)
+
+    @property
+    def account_totals(self):
+        return loads(self.accounts)
+
+    def to_dict(self):
+        def money(value):
+            return None if value is None else h.money(value)
+
+        return {
+            "month": h.date_to_month_input(self.month),
+            "total_outgoings": money(self.total_outgoings),
+            "emergency_fund_target": money(self.emergency_fund_target),
+            "annual_expense_total": money(self.annual_expense_total),
+            "annual_expense_target_balance": money(
+                self.annual_expense_target_balance
+            ),
+            "net_monthly_salary": money(self.net_monthly_salary),
+            "accounts": self.account_totals,
+        }
+
+
+class StoredSession(db.Model):
+    """Session data for the "database" SESSION_STORE (see sessions.py). The
+    id is a hash of the session id held in the cookie."""
+
+    __tablename__ = "session"
+
+    id = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.Text, nullable=False)
+    expires = db.Column(db.DateTime, nullable=False, index=True)
+
+
+@event.listens_for(Outgoing, "before_insert")
+@event.listens_for(Outgoing, "before_update")
+def set_outgoing_month_indexes(mapper, connection, outgoing):
+    outgoing.start_month_idx, outgoing.end_month_idx = Outgoing.month_indexes(
+        outgoing.start_month, outgoing.end_month
+    )
+
+
+def mark_users_changed(session, user_ids):
+    """Increments the data version of the given users so that previously
+    calculated figures are no longer used. This must be called within the
+    transaction making the change."""
+    if len(user_ids) == 0:
+        return
+
+    session.connection().execute(
+        User.__table__.update()
+        .where(User.id.in_(user_ids))
+        .values(data_version=User.data_version + 1)
+    )
+    session.info.setdefault("changed_user_ids", set()).update(user_ids)
+
+
+@event.listens_for(db.session, "after_flush")
+def increment_data_versions(session, flush_context):
+    """Marks any user whose data was changed by the flush as changed. Bulk
+    statements that bypass the flush must call mark_users_changed()
+    themselves."""
+    mark_users_changed(
+        session,
+        {
+            instance.user_id
+            for instance in session.new | session.dirty | session.deleted
+            if isinstance(
+                instance, (Configuration, Account, Outgoing, AnnualExpense)
+            )
+            and instance.user_id is not None
+        },
+    )
+
+
+def adjust_annual_expense_total(session, user_id, delta):
+    """Adds delta to a users stored annual expense total. Bulk statements
+    that bypass the flush must call this themselves."""
+    if delta == 0:
+        return
+
+    session.connection().execute(
+        User.__table__.update()
+        .where(User.id == user_id)
+        .values(annual_expense_total=User.annual_expense_total + delta)
+    )
+
+
+@event.listens_for(db.session, "before_flush")
+def adjust_annual_expense_totals(session, flush_context, instances):
+    """Keeps each users annual expense total up to date by applying the
+    difference made by each added, changed or removed annual expense, so
+    the total never needs to be recalculated from every expense."""
+    deltas = defaultdict(Decimal)
+    for annual_expense in session.new:
+        if isinstance(annual_expense, AnnualExpense):
+            deltas[annual_expense.user_id] += Decimal(
+                str(annual_expense.value)
+            )
+    for annual_expense in session.deleted:
+        if isinstance(annual_expense, AnnualExpense):
+            deltas[annual_expense.user_id] -= Decimal(
+                str(annual_expense.value)
+            )
+    for annual_expense in session.dirty:
+        if not isinstance(annual_expense, AnnualExpense):
+            continue
+        history = inspect(annual_expense).attrs.value.history
+        if history.has_changes():
+            for value in history.added:
+                deltas[annual_expense.user_id] += Decimal(str(value))
+            for value in history.deleted:
+                deltas[annual_expense.user_id] -= Decimal(str(value))
+
+    for user_id, delta in deltas.items():
+        adjust_annual_expense_total(session, user_id, delta)
+
+
+@event.listens_for(db.session, "after_commit")
+def invalidate_summary_cache(session):
+    for user_id in session.info.pop("changed_user_ids", set()):
+        summary_cache.invalidate(user_id)
+
+
+@event.listens_for(db.session, "after_rollback")
+def discard_changed_user_ids(session):
+    session.info.pop("changed_user_ids", None)
+
+
+def import_rows(user, rows):
+    """Imports accounts, outgoings and annual expenses for a user from rows in
+    the format described in transfer.py, in a single transaction.
+
+    Outgoings reference their account by name and any accounts that do not
+    already exist are created. Every row is validated before anything is
+    written and transfer.InvalidImport is raised if any are invalid. Returns
+    the number of accounts, outgoings and annual expenses imported.
+    """
+    parsed_rows = transfer.parse_rows(rows)
+
+    try:
+        account_ids = {
+            name.lower(): id
+            for id, name in db.session.query(Account.id, Account.name).filter(
+                Account.user_id == user.id
+            )
+        }
+        new_accounts = {}
+        for row in parsed_rows:
+            if row["type"] == "account":
+                name, notes = row["name"], row["notes"]
+            elif row["type"] == "outgoing":
+                name, notes = row["account"], None
+            else:
+                continue
+            if name.lower() not in account_ids:
+                new_accounts.setdefault(
+                    name.lower(), Account(user.id, name, notes)
+                )
+        db.session.add_all(new_accounts.values())
+        db.session.flush()
+        account_ids.update(
+            {key: account.id for key, account in new_accounts.items()}
+        )
+
+        outgoings = []
+        annual_expenses = []
+        for row in parsed_rows:
+            if row["type"] == "outgoing":
+                start_month_idx, end_month_idx = Outgoing.month_indexes(
+                    row["start_month"], row["end_month"]
+                )
+                outgoings.append(
+                    {
+                        "user_id": user.id,
+                        "account_id": account_ids[row["account"].lower()],
+                        "name": row["name"],
+                        "value": row["value"],
+                        "start_month": row["start_month"],
+                        "end_month": row["end_month"],
+                        "start_month_idx": start_month_idx,
+                        "end_month_idx": end_month_idx,
+                        "notes": row["notes"],
+                        "emergency_fund_excluded": row[
+                            "emergency_fund_excluded"
+                        ],
+                    }
+                )
+            elif row["type"] == "annual_expense":
+                annual_expenses.append(
+                    {
+                        "user_id": user.id,
+                        "month_paid": row["month_paid"],
+                        "name": row["name"],
+                        "value": row["value"],
+                        "notes": row["notes"],
+                    }
+                )
+
+        # Insert each table with a single executemany statement.
+        if len(outgoings) > 0:
+            db.session.execute(Outgoing.__table__.insert(), outgoings)
+        if len(annual_expenses) > 0:
+            db.session.execute(
+                AnnualExpense.__table__.insert(), annual_expenses
+            )
+            adjust_annual_expense_total(
+                db.session,
+                user.id,
+                sum(
+                    annual_expense["value"]
+                    for annual_expense in annual_expenses
+                ),
+            )
+        mark_users_changed(db.session, {user.id})
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    if len(annual_expenses) > 0:
+        AnnualExpense.update_user_annual_expense_outgoing(user)
+
+    return len(new_accounts), len(outgoings), len(annual_expenses)
+
+
+def export_rows(user_id=None):
+    """Yields a row (see transfer.EXPORT_FIELDS) for the configuration and
+    each account, outgoing and annual expense of the given user, or of every
+    user if user_id is None. Each row also includes the users username.
+
+    Only columns are selected and results are fetched in batches (using
+    server side cursors where the database supports them) so that exporting
+    a large database never loads it all into memory.
+    """
+
+    def batched(query, model):
+        if user_id is not None:
+            query = query.filter(model.user_id == user_id)
+        return query.order_by(model.user_id, model.id).yield_per(
+            EXPORT_BATCH_SIZE
+        )
+
+    linked_outgoing = db.aliased(Outgoing)
+    for (
+        username,
+        annual_net_salary,
+        emergency_fund_months,
+        annual_expense_outgoing,
+    ) in batched(
+        db.session.query(
+            User.username,
+            Configuration.annual_net_salary,
+            Configuration.emergency_fund_months,
+            linked_outgoing.name,
+        )
+        .select_from(Configuration)
+        .join(User, Configuration.user_id == User.id)
+        .outerjoin(
+            linked_outgoing,
+            Configuration.annual_expense_outgoing_id == linked_outgoing.id,
+        ),
+        Configuration,
+    ):
+        yield {
+            "username": username,
+            "type": "configuration",
+            "annual_net_salary": None
+            if annual_net_salary is None
+            else h.money(annual_net_salary),
+            "emergency_fund_months": emergency_fund_months,
+            "annual_expense_outgoing": annual_expense_outgoing,
+        }
+
+    for username, name, notes in batched(
+        db.session.query(User.username, Account.name, Account.notes)
+        .select_from(Account)
+        .join(User, Account.user_id == User.id),
+        Account,
+    ):
+        yield {
+            "username": username,
+            "type": "account",
+            "name": name,
+            "notes": notes,
+        }
+
+    for (
+        username,
+        account,
+        name,
+        value,
+        start_month,
+        end_month,
+        notes,
+        emergency_fund_excluded,
+    ) in batched(
+        db.session.query(
+            User.username,
+            Account.name,
+            Outgoing.name,
+            Outgoing.value,
+            Outgoing.start_month,
+            Outgoing.end_month,
+            Outgoing.notes,
+            Outgoing.emergency_fund_excluded,
+        )
+        .select_from(Outgoing)
+        .join(User, Outgoing.user_id == User.id)
+        .join(Account, Outgoing.account_id == Account.id),
+        Outgoing,
+    ):
+        yield {
+            "username": username,
+            "type": "outgoing",
+            "account": account,
+            "name": name,
+            "value": h.money(value),
+            "start_month": h.date_to_month_input(start_month),
+            "end_month": h.date_to_month_input(end_month),
+            "notes": notes,
+            "emergency_fund_excluded": emergency_fund_excluded is True,
+        }
+
+    for username, month_paid, name, value, notes in batched(
+        db.session.query(
+            User.username,
+            AnnualExpense.month_paid,
+            AnnualExpense.name,
+            AnnualExpense.value,
+            AnnualExpense.notes,
+        )
+        .select_from(AnnualExpense)
+        .join(User, AnnualExpense.user_id == User.id),
+        AnnualExpense,
+    ):
+        yield {
+            "username": username,
+            "type": "annual_expense",
+            "name": name,
+            "value": h.money(value),
+            "month_paid": month_paid,
+            "notes": notes,
+        }
+
+
+def upgrade_database():
+    """Brings a database created by an earlier version up to date by adding
+    any missing tables, columns and indexes."""
+    db.create_all()
+
+    inspector = inspect(db.engine)
+    added_columns = set()
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            existing_columns = {
+                column["name"] for column in inspector.get_columns(table.name)
+            }
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                column_definition = CreateColumn(column).compile(
+                    dialect=db.engine.dialect
+                )
+                connection.execute(
+                    db.text(
+                        f'ALTER TABLE "{table.name}" '
+                        f"ADD COLUMN {column_definition}"
+                    )
+                )
+                added_columns.add((table.name, column.name))
+
+        if ("user", "annual_expense_total") in added_columns:
+            annual_expense = AnnualExpense.__table__
+            connection.execute(
+                User.__table__.update().values(
+                    annual_expense_total=db.select(
+                        db.func.coalesce(
+                            db.func.sum(annual_expense.c.value), 0
+                        )
+                    )
+                    .where(annual_expense.c.user_id == User.__table__.c.id)
+                    .scalar_subquery()
+                )
+            )
+
+        if ("outgoing", "start_month_idx") in added_columns:
+            outgoing = Outgoing.__table__
+            for id, start_month, end_month in connection.execute(
+                db.select(
+                    [
+                        outgoing.c.id,
+                        outgoing.c.start_month,
+                        outgoing.c.end_month,
+                    ]
+                )
+            ).fetchall():
+                start_month_idx, end_month_idx = Outgoing.month_indexes(
+                    start_month, end_month
+                )
+                connection.execute(
+                    outgoing.update()
+                    .where(outgoing.c.id == id)
+                    .values(
+                        start_month_idx=start_month_idx,
+                        end_month_idx=end_month_idx,
+                    )
+                )
+
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+    return sorted(added_columns)
 
 
 def env_user():
@@ -515,22 +1532,93 @@ def env_user():
 
     existing_user = User.query.filter_by(username=username.lower()).first()
     if existing_user is None:
-        db.session.add(User(username, password))
+        db.session.add(User(username, passwords.hash_password(password)))
     else:
-        existing_user.password = h.hash(password, PASSWORD_SALT)
+        existing_user.password = passwords.hash_password(password)
 
     db.session.commit()
 
 
-env_user()
 # endregion
 
 
 # region Routes
-@app.after_request
+class CurrentUser:
+    """The logged in user of the current request (see current_user). The id
+    is taken from the session and the User is only loaded when it is first
+    needed, so routes that only work with the users own rows don't need to
+    query the user table."""
+
+    def __init__(self, user_id):
+        self.id = user_id
+        self._user = None
+
+    def load(self, *options):
+        """Returns the User, loaded with the given loader options (see
+        User.load) the first time it is needed in the request."""
+        if self._user is None:
+            self._user = User.load(self.id, *options)
+        return self._user
+
+
+def get_current_user():
+    if "current_user" not in g:
+        g.current_user = CurrentUser(session["user_id"])
+    return g.current_user
+
+
+# Only available in routes that require login
+current_user = LocalProxy(get_current_user)
+
+
+def concurrent_reads(*funcs):
+    """Returns a list of the results of calling each of funcs. When the
+    CONCURRENT_READS config option is set they are run at the same time by
+    a pool of that many threads, cutting the time spent waiting for a remote
+    database. Each runs in its own app context, so with its own database
+    session and connection, and must return results that don't need the
+    session, e.g. plain values or fully loaded objects. Otherwise they are
+    run one after another."""
+    executor = current_app.extensions.get("read_executor")
+    if executor is None:
+        return [func() for func in funcs]
+
+    app = current_app._get_current_object()
+
+    def read(func):
+        with app.app_context():
+            return func()
+
+    futures = [
+        executor.submit(count_queries_in_thread(read), func) for func in funcs
+    ]
+    return [future.result() for future in futures]
+
+
+def dashboard_figures(user):
+    """Returns the dashboard summary, end of month target balance and this
+    months annual expenses of a user loaded with their configuration. These
+    are independent so are read concurrently if enabled."""
+    current_month = h.current_month_num()
+    return concurrent_reads(
+        user.cached_dashboard_summary,
+        user.cached_end_of_month_target_balance,
+        lambda: AnnualExpense.by_month_range(
+            user, current_month, current_month
+        ).all(),
+    )
+
+
 def set_response_headers(response):
     """Add no-cache headers to every response to prevent the dynamically generated
-    pages from being cached."""
+    pages from being cached. Responses that set their own caching policy, such
+    as the API and fingerprinted static files (see assets.py), are left as
+    they are. Other static files may be cached but must be revalidated."""
+    if "Cache-Control" in response.headers:
+        return response
+    if request.endpoint == "static":
+        response.cache_control.no_cache = True
+        return response
     response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     response.headers["Pragma"] = "no-cache"
     response.headers["Expires"] = "0"
@@ -538,13 +1626,13 @@ def set_response_headers(response):
 
 
 # region Login
-@app.route("/login")
+@route("/login")
 def login():
     message = request.args.get("message")
     return render_template("login.html", message=message)
 
 
-@app.route("/login-handler", methods=["POST"])
+@route("/login-handler", methods=["POST"])
 def login_handler():
     login_result = User.login(
         request.form["username"],
@@ -558,7 +1646,7 @@ def login_handler():
         return redirect(url_for("index"))
 
 
-@app.route("/logout")
+@route("/logout")
 def logout():
     session.clear()
     return redirect(url_for("login"))
@@ -568,25 +1656,24 @@ def logout():
 
 
 # region Index
-@app.route("/")
+@route("/")
 @User.login_required
+@query_budget(4)
 def index():
-    user = User.query.get(session["user_id"])
+    user = current_user.load(db.joinedload(User.configuration))
 
     if user.configuration_required():
         return redirect(url_for("configuration"))
 
-    current_month = h.current_month_num()
-    current_month_annual_expenses = AnnualExpense.by_month_range(
-        user, current_month, current_month
-    )
-    end_of_month_target_balance = AnnualExpense.end_of_month_target_balance(
-        user
-    )
+    (
+        summary,
+        end_of_month_target_balance,
+        current_month_annual_expenses,
+    ) = dashboard_figures(user)
 
     return render_template(
         "index.html",
-        user=user,
+        summary=summary,
         current_month_annual_expenses=current_month_annual_expenses,
         end_of_month_target_balance=end_of_month_target_balance,
     )
@@ -595,20 +1682,26 @@ def index():
 # endregion
 
 # region Configuration
-@app.route("/configuration")
+@route("/configuration")
 @User.login_required
+@query_budget(2)
 def configuration():
-    user = User.query.get(session["user_id"])
+    user = current_user.load(
+        db.joinedload(User.configuration),
+        db.selectinload(User.outgoings),
+    )
 
     return render_template("configuration.html", user=user)
 
 
-@app.route("/configuration-handler", methods=["POST"])
+@route("/configuration-handler", methods=["POST"])
 @User.login_required
 def configuration_handler():
-    user = User.query.get(session["user_id"])
+    user = current_user.load()
 
     form_data = h.empty_strings_to_none(request.form)
+    if form_data["annual_expense_outgoing_id"] is not None:
+        Outgoing.get_owned(user.id, form_data["annual_expense_outgoing_id"])
 
     if user.configuration is None:
         db.session.add(
@@ -639,54 +1732,49 @@ def configuration_handler():
 
 
 # region Accounts
-@app.route("/accounts")
+@route("/accounts")
 @User.login_required
+@query_budget(2)
 def accounts():
-    user = User.query.get(session["user_id"])
+    user = current_user.load(db.selectinload(User.accounts))
 
     return render_template("accounts.html", user=user)
 
 
-@app.route("/new-account")
+@route("/new-account")
 @User.login_required
 def new_account():
     return render_template("new-account.html")
 
 
-@app.route("/new-account-handler", methods=["POST"])
+@route("/new-account-handler", methods=["POST"])
 @User.login_required
 def new_account_handler():
-    user = User.query.get(session["user_id"])
-
     form_data = h.empty_strings_to_none(request.form)
 
-    db.session.add(Account(user.id, form_data["name"], form_data["notes"]))
+    db.session.add(
+        Account(current_user.id, form_data["name"], form_data["notes"])
+    )
     db.session.commit()
 
     return redirect(url_for("accounts"))
 
 
-@app.route("/edit-account/<account_id>")
+@route("/edit-account/<int:account_id>")
 @User.login_required
 def edit_account(account_id):
-    user = User.query.get(session["user_id"])
-
     return render_template(
         "edit-account.html",
-        account=Account.query.filter_by(
-            user_id=user.id, id=account_id
-        ).first(),
+        account=Account.get_owned(current_user.id, account_id),
     )
 
 
-@app.route("/edit-account-handler/<account_id>", methods=["POST"])
+@route("/edit-account-handler/<int:account_id>", methods=["POST"])
 @User.login_required
 def edit_account_handler(account_id):
-    user = User.query.get(session["user_id"])
-
     form_data = h.empty_strings_to_none(request.form)
 
-    account = Account.query.filter_by(user_id=user.id, id=account_id).first()
+    account = Account.get_owned(current_user.id, account_id)
 
     account.name = form_data["name"]
     account.notes = form_data["notes"]
@@ -696,12 +1784,10 @@ def edit_account_handler(account_id):
     return redirect(url_for("accounts"))
 
 
-@app.route("/delete-account-handler/<account_id>")
+@route("/delete-account-handler/<int:account_id>")
 @User.login_required
 def delete_account_handler(account_id):
-    user = User.query.get(session["user_id"])
-
-    account = Account.query.filter_by(user_id=user.id, id=account_id).first()
+    account = Account.get_owned(current_user.id, account_id)
 
     account.delete()
 
@@ -712,20 +1798,28 @@ def delete_account_handler(account_id):
 
 
 # region Monthly Outgoings
-@app.route("/outgoings")
+@route("/outgoings")
 @User.login_required
+@query_budget(3)
 def outgoings():
-    user = User.query.get(session["user_id"])
+    user = current_user.load(
+        db.joinedload(User.configuration),
+        db.selectinload(User.accounts).selectinload(Account.outgoings),
+    )
 
     return render_template(
-        "outgoings.html", user=user, todays_date=date.today()
+        "outgoings.html",
+        user=user,
+        todays_date=date.today(),
+        message=request.args.get("message"),
     )
 
 
-@app.route("/new-outgoing")
+@route("/new-outgoing")
 @User.login_required
+@query_budget(2)
 def new_outgoing():
-    user = User.query.get(session["user_id"])
+    user = current_user.load(db.selectinload(User.accounts))
 
     # Note: This does no harm if the id is another users. It's only used to
     # auto select a selection input.
@@ -736,19 +1830,19 @@ def new_outgoing():
     )
 
 
-@app.route("/new-outgoing-handler", methods=["POST"])
+@route("/new-outgoing-handler", methods=["POST"])
 @User.login_required
 def new_outgoing_handler():
-    user = User.query.get(session["user_id"])
-
     form_data = h.empty_strings_to_none(request.form)
 
+    account = Account.get_owned(current_user.id, form_data["account_id"])
+
     db.session.add(
         Outgoing(
-            user.id,
+            current_user.id,
             form_data["name"],
             form_data["value"],
-            form_data["account_id"],
+            account.id,
             start_month=h.month_input_to_date(form_data["start_month"]),
             end_month=h.month_input_to_date(
                 form_data["end_month"], set_to_last_day=True
@@ -764,32 +1858,31 @@ def new_outgoing_handler():
     return redirect(url_for("outgoings"))
 
 
-@app.route("/edit-outgoing/<outgoing_id>")
+@route("/edit-outgoing/<int:outgoing_id>")
 @User.login_required
+@query_budget(3)
 def edit_outgoing(outgoing_id):
-    user = User.query.get(session["user_id"])
+    user = current_user.load(
+        db.joinedload(User.configuration),
+        db.selectinload(User.accounts),
+    )
 
     return render_template(
         "edit-outgoing.html",
         user=user,
-        outgoing=Outgoing.query.filter_by(
-            user_id=user.id, id=outgoing_id
-        ).first(),
+        outgoing=Outgoing.get_owned(user.id, outgoing_id),
     )
 
 
-@app.route("/edit-outgoing-handler/<outgoing_id>", methods=["POST"])
+@route("/edit-outgoing-handler/<int:outgoing_id>", methods=["POST"])
 @User.login_required
 def edit_outgoing_handler(outgoing_id):
-    user = User.query.get(session["user_id"])
-
     form_data = h.empty_strings_to_none(request.form)
 
-    outgoing = Outgoing.query.filter_by(
-        user_id=user.id, id=outgoing_id
-    ).first()
+    outgoing = Outgoing.get_owned(current_user.id, outgoing_id)
+    account = Account.get_owned(current_user.id, form_data["account_id"])
 
-    outgoing.account_id = form_data["account_id"]
+    outgoing.account_id = account.id
     outgoing.name = form_data["name"]
     outgoing.value = form_data["value"]
     outgoing.start_month = h.month_input_to_date(form_data.get("start_month"))
@@ -806,46 +1899,87 @@ def edit_outgoing_handler(outgoing_id):
     return redirect(url_for("outgoings"))
 
 
-@app.route("/delete-outgoing-handler/<outgoing_id>")
+@route("/delete-outgoing-handler/<int:outgoing_id>")
 @User.login_required
 def delete_outgoing_handler(outgoing_id):
-    user = User.query.get(session["user_id"])
-
-    outgoing = Outgoing.query.filter_by(
-        user_id=user.id, id=outgoing_id
-    ).first()
+    outgoing = Outgoing.get_owned(current_user.id, outgoing_id)
 
     outgoing.delete()
 
     return redirect(url_for("outgoings"))
 
 
+@route("/bulk-outgoings-handler", methods=["POST"])
+@User.login_required
+@query_budget(5)
+def bulk_outgoings_handler():
+    """Applies an action to all of the outgoings selected on the outgoings
+    page at once."""
+    user_id = current_user.id
+    outgoing_ids = request.form.getlist("outgoing_id", type=int)
+    action = request.form.get("action")
+
+    if len(outgoing_ids) == 0:
+        pass
+    elif action == "delete":
+        Outgoing.bulk_delete(user_id, outgoing_ids)
+    elif action == "move":
+        account = Account.get_owned(
+            user_id, request.form.get("account_id", type=int)
+        )
+        Outgoing.bulk_update(user_id, outgoing_ids, account_id=account.id)
+    elif action == "end_month":
+        try:
+            end_month = h.month_input_to_date(
+                request.form.get("end_month") or None, set_to_last_day=True
+            )
+        except ValueError:
+            return redirect(
+                url_for("outgoings", message="Invalid last month paid.")
+            )
+        try:
+            Outgoing.bulk_update(user_id, outgoing_ids, end_month=end_month)
+        except ValueError as e:
+            return redirect(url_for("outgoings", message=str(e)))
+    elif action in ("exclude", "include"):
+        Outgoing.bulk_update(
+            user_id,
+            outgoing_ids,
+            emergency_fund_excluded=(action == "exclude"),
+        )
+
+    return redirect(url_for("outgoings"))
+
+
 # endregion
 
 
 # region Annual Expenses
-@app.route("/annual-expenses")
+@route("/annual-expenses")
 @User.login_required
+@query_budget(2)
 def annual_expenses():
-    user = User.query.get(session["user_id"])
+    user = current_user.load()
+    months_expenses, annual_total = AnnualExpense.grouped_by_month(user)
 
-    return render_template("annual-expenses.html", user=user, months=h.months)
+    return render_template(
+        "annual-expenses.html",
+        months_expenses=months_expenses,
+        annual_total=annual_total,
+        months=h.months,
+    )
 
 
-@app.route("/new-annual-expense")
+@route("/new-annual-expense")
 @User.login_required
 def new_annual_expense():
-    user = User.query.get(session["user_id"])
-
-    return render_template(
-        "new-annual-expense.html", user=user, months=h.months
-    )
+    return render_template("new-annual-expense.html", months=h.months)
 
 
-@app.route("/new-annual-expense-handler", methods=["POST"])
+@route("/new-annual-expense-handler", methods=["POST"])
 @User.login_required
 def new_annual_expense_handler():
-    user = User.query.get(session["user_id"])
+    user = current_user.load()
 
     form_data = h.empty_strings_to_none(request.form)
 
@@ -865,33 +1999,28 @@ def new_annual_expense_handler():
     return redirect(url_for("annual_expenses"))
 
 
-@app.route("/edit-annual-expense/<annual_expense_id>")
+@route("/edit-annual-expense/<int:annual_expense_id>")
 @User.login_required
 def edit_annual_expense(annual_expense_id):
-    user = User.query.get(session["user_id"])
-
     return render_template(
         "edit-annual-expense.html",
-        user=user,
-        annual_expense=AnnualExpense.query.filter_by(
-            user_id=user.id, id=annual_expense_id
-        ).first(),
+        annual_expense=AnnualExpense.get_owned(
+            current_user.id, annual_expense_id
+        ),
         months=h.months,
     )
 
 
-@app.route(
-    "/edit-annual-expense-handler/<annual_expense_id>", methods=["POST"]
+@route(
+    "/edit-annual-expense-handler/<int:annual_expense_id>", methods=["POST"]
 )
 @User.login_required
 def edit_annual_expense_handler(annual_expense_id):
-    user = User.query.get(session["user_id"])
+    user = current_user.load()
 
     form_data = h.empty_strings_to_none(request.form)
 
-    annual_expense = AnnualExpense.query.filter_by(
-        user_id=user.id, id=annual_expense_id
-    ).first()
+    annual_expense = AnnualExpense.get_owned(user.id, annual_expense_id)
 
     annual_expense.month_paid = form_data["month_paid"]
     annual_expense.name = form_data["name"]
@@ -905,14 +2034,12 @@ def edit_annual_expense_handler(annual_expense_id):
     return redirect(url_for("annual_expenses"))
 
 
-@app.route("/delete-annual-expense-handler/<annual_expense_id>")
+@route("/delete-annual-expense-handler/<int:annual_expense_id>")
 @User.login_required
 def delete_annual_expense_handler(annual_expense_id):
-    user = User.query.get(session["user_id"])
+    user = current_user.load()
 
-    annual_expense = AnnualExpense.query.filter_by(
-        user_id=user.id, id=annual_expense_id
-    ).first()
+    annual_expense = AnnualExpense.get_owned(user.id, annual_expense_id)
 
     annual_expense.delete()
 
@@ -922,4 +2049,525 @@ def delete_annual_expense_handler(annual_expense_id):
 
 
 # endregion
+
+# region Forecast
+def requested_forecast_months():
+    """The number of forecast months requested in the query string."""
+    months = request.args.get("months", DEFAULT_FORECAST_MONTHS, type=int)
+    return min(max(months, 1), MAX_FORECAST_MONTHS)
+
+
+@route("/forecast")
+@User.login_required
+@query_budget(5)
+def forecast():
+    user = current_user.load(db.joinedload(User.configuration))
+
+    return render_template(
+        "forecast.html",
+        forecast=user.forecast(requested_forecast_months()),
+    )
+
+
+@route("/forecast-data")
+def forecast_data():
+    """Replaced by /api/v1/forecast, kept for existing clients."""
+    return redirect(url_for("api_forecast", **request.args), code=301)
+
+
+# endregion
+
+# region Trends
+# The ids of the users known to have a snapshot for the current month, by
+# month index. Only the current month is kept.
+snapshotted_users = {}
+
+
+def take_missing_snapshot():
+    """Takes the logged in users snapshot for the current month on their
+    first request of the month, in case it wasn't taken by the snapshot
+    command. Each user is only checked once a month by each process."""
+    if request.endpoint in ("static", "asset"):
+        return  # Leave the session unread so Vary: Cookie isn't added
+
+    # Sessions that have timed out are left for login_required to reject
+    if User.session_idle_seconds() is None:
+        return
+    user_id = session["user_id"]
+
+    month_idx = comparison_month_index()
+    user_ids = snapshotted_users.get(month_idx)
+    if user_ids is None:
+        snapshotted_users.clear()
+        user_ids = snapshotted_users.setdefault(month_idx, set())
+    if user_id in user_ids:
+        return
+
+    user = User.query.get(user_id)
+    if user is not None:
+        MonthlySnapshot.take(user)
+    user_ids.add(user_id)
+
+
+@route("/trends")
+@User.login_required
+@query_budget(1)
+def trends():
+    snapshots = MonthlySnapshot.for_user(current_user.id)
+
+    # Every account that appears in any snapshot, by id, with its most
+    # recent name
+    accounts = {}
+    rows = []
+    for snapshot in snapshots:
+        account_totals = {}
+        for account in snapshot.account_totals:
+            accounts[account["id"]] = account["name"]
+            account_totals[account["id"]] = account["total_outgoings"]
+        rows.append((snapshot, account_totals))
+
+    return render_template(
+        "trends.html", rows=list(reversed(rows)), accounts=accounts
+    )
+
+
+# endregion
+
+
+# region Import
+@route("/import")
+@User.login_required
+def import_data():
+    return render_template(
+        "import.html",
+        fields=transfer.FIELDS,
+        message=request.args.get("message"),
+    )
+
+
+@route("/import-handler", methods=["POST"])
+@User.login_required
+def import_handler():
+    user = current_user.load(db.joinedload(User.configuration))
+
+    upload = request.files.get("file")
+    try:
+        if upload is None or upload.filename == "":
+            raise transfer.InvalidImport(["Please choose a file to import."])
+        rows = transfer.read_rows(
+            transfer.text_stream(upload.stream),
+            transfer.format_from_filename(upload.filename),
+        )
+        accounts, outgoings, annual_expenses = import_rows(user, rows)
+    except ValueError as e:
+        errors = (
+            e.errors if isinstance(e, transfer.InvalidImport) else [str(e)]
+        )
+        return (
+            render_template(
+                "import.html", fields=transfer.FIELDS, errors=errors
+            ),
+            400,
+        )
+
+    return redirect(
+        url_for(
+            "import_data",
+            message=f"Imported {accounts} account(s), {outgoings} "
+            f"outgoing(s) and {annual_expenses} annual expense(s).",
+        )
+    )
+
+
+# endregion
+
+
+# region Export
+@route("/export")
+@User.login_required
+def export_data():
+    file_format = request.args.get("format", "csv")
+    if file_format not in transfer.FORMATS:
+        return redirect(url_for("configuration"))
+
+    return Response(
+        stream_with_context(
+            transfer.write_rows(
+                export_rows(current_user.id),
+                file_format,
+                transfer.EXPORT_FIELDS,
+            )
+        ),
+        mimetype=transfer.MIMETYPES[file_format],
+        headers={
+            "Content-Disposition": "attachment; "
+            f"filename=bluesheet-{date.today().isoformat()}.{file_format}"
+        },
+    )
+
+
+# endregion
+
+
+# region API
+def api_response(user, get_data):
+    """Returns the result of get_data() as JSON along with an ETag derived from
+    the users data version. If the client already holds the current version a
+    304 Not Modified response is returned without calling get_data().
+
+    The ETag is weak as it identifies the data rather than the exact bytes
+    sent, which differ when the response is compressed. The same ETag is
+    sent with both 200 and 304 responses.
+    """
+    etag = f"v1-{user.id}-{user.data_version}-{comparison_month_index()}"
+
+    if request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = jsonify(get_data())
+
+    response.set_etag(etag, weak=True)
+    # Allow clients to keep a copy but require them to revalidate it.
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+@route("/api/v1/summary")
+@User.login_required
+@query_budget(4)
+def api_summary():
+    user = current_user.load(db.joinedload(User.configuration))
+
+    def summary():
+        (
+            dashboard_summary,
+            end_of_month_target_balance,
+            current_month_annual_expenses,
+        ) = dashboard_figures(user)
+        summary = dashboard_summary.to_dict()
+        summary["end_of_month_target_balance"] = h.money(
+            end_of_month_target_balance
+        )
+        summary["current_month_annual_expenses"] = [
+            annual_expense.to_dict()
+            for annual_expense in current_month_annual_expenses
+        ]
+        return summary
+
+    return api_response(user, summary)
+
+
+@route("/api/v1/outgoings")
+@User.login_required
+@query_budget(3)
+def api_outgoings():
+    user = current_user.load(db.joinedload(User.configuration))
+
+    def outgoings():
+        accounts = Account.query.options(
+            db.selectinload(Account.outgoings)
+        ).filter_by(user_id=user.id)
+        return {
+            "annual_expense_outgoing_id": None
+            if user.configuration is None
+            else user.configuration.annual_expense_outgoing_id,
+            "accounts": [
+                {
+                    "id": account.id,
+                    "name": account.name,
+                    "notes": account.notes,
+                    "outgoings": [
+                        outgoing.to_dict() for outgoing in account.outgoings
+                    ],
+                }
+                for account in accounts
+            ],
+        }
+
+    return api_response(user, outgoings)
+
+
+@route("/api/v1/annual-expenses")
+@User.login_required
+@query_budget(2)
+def api_annual_expenses():
+    user = current_user.load()
+
+    def annual_expenses():
+        months_expenses, annual_total = AnnualExpense.grouped_by_month(user)
+
+        monthly_totals = [0] * 12
+        for month_paid, _, subtotal in months_expenses:
+            monthly_totals[month_paid - 1] = subtotal
+        trajectory = AnnualExpense.balance_trajectory(
+            user, monthly_totals=monthly_totals
+        )
+
+        return {
+            "months": [
+                {
+                    "month_paid": month_paid,
+                    "month_name": h.months[month_paid],
+                    "subtotal": h.money(subtotal),
+                    "annual_expenses": [
+                        annual_expense.to_dict()
+                        for annual_expense in month_expenses
+                    ],
+                }
+                for month_paid, month_expenses, subtotal in months_expenses
+            ],
+            "annual_total": h.money(annual_total),
+            "monthly_saving": h.money(annual_total / 12),
+            "end_of_month_target_balance": h.money(
+                -min(balance for _, balance in trajectory)
+            ),
+            "balance_trajectory": [
+                {"month_paid": month_paid, "balance": h.money(balance)}
+                for month_paid, balance in trajectory
+            ],
+        }
+
+    return api_response(user, annual_expenses)
+
+
+@route("/api/v1/forecast")
+@User.login_required
+@query_budget(5)
+def api_forecast():
+    user = current_user.load(db.joinedload(User.configuration))
+
+    return api_response(
+        user, lambda: user.forecast(requested_forecast_months()).to_dict()
+    )
+
+
+@route("/api/v1/trends")
+@User.login_required
+@query_budget(2)
+def api_trends():
+    user = current_user.load()
+
+    return api_response(
+        user,
+        lambda: {
+            "months": [
+                snapshot.to_dict()
+                for snapshot in MonthlySnapshot.for_user(user.id)
+            ]
+        },
+    )
+
+
+# endregion
+# endregion
+
+
+# region Application
+def config_from_environment():
+    """Returns the app configuration set by environment variables."""
+
+    def flag(name, default="false"):
+        return environ.get(name, default).lower() == "true"
+
+    # SQLAlchemy no longer accepts the postgres:// scheme used by some hosts
+    database_url = environ.get("DATABASE_URL", "sqlite:///database.db")
+    if database_url.startswith("postgres://"):
+        database_url = "postgresql://" + database_url[len("postgres://") :]
+
+    return {
+        "SECRET_KEY": environ.get("SESSION_KEY"),
+        "PASSWORD_SALT": environ.get("PASSWORD_SALT"),
+        "SQLALCHEMY_DATABASE_URI": database_url,
+        "SESSION_STORE": environ.get("SESSION_STORE", "cookie").lower(),
+        "SUMMARY_CACHE_MAX_BYTES": int(
+            environ.get("SUMMARY_CACHE_MAX_BYTES", 8 * 1024 * 1024)
+        ),
+        "ENFORCE_QUERY_BUDGETS": flag("ENFORCE_QUERY_BUDGETS"),
+        "METRICS_ENABLED": flag("METRICS_ENABLED"),
+        "SERVER_TIMING": flag("SERVER_TIMING"),
+        "SQLITE_PROFILE": environ.get("SQLITE_PROFILE", "default").lower(),
+        "SQLITE_POOL_SIZE": int(environ.get("SQLITE_POOL_SIZE", 5)),
+        "DATABASE_POOL_SIZE": int(environ.get("DATABASE_POOL_SIZE", 5)),
+        "DATABASE_MAX_OVERFLOW": int(environ.get("DATABASE_MAX_OVERFLOW", 5)),
+        "DATABASE_POOL_TIMEOUT": int(environ.get("DATABASE_POOL_TIMEOUT", 30)),
+        "DATABASE_POOL_RECYCLE": int(
+            environ.get("DATABASE_POOL_RECYCLE", 1800)
+        ),
+        "DATABASE_POOL_PRE_PING": flag("DATABASE_POOL_PRE_PING", "true"),
+        "CONCURRENT_READS": int(environ.get("CONCURRENT_READS", 0)),
+        "MINIFY_HTML": flag("MINIFY_HTML"),
+        "COMPRESS_RESPONSES": flag("COMPRESS_RESPONSES"),
+        "COMPRESS_MIN_BYTES": int(environ.get("COMPRESS_MIN_BYTES", 1024)),
+        "COMPRESS_LEVEL": int(environ.get("COMPRESS_LEVEL", 6)),
+    }
+
+
+def create_app(config=None):
+    """Returns a configured app. The configuration is read from environment
+    variables, with any values in config taking precedence.
+
+    No database connection is made here. The database is brought up to date
+    by init_database, which is run by the gunicorn master before workers are
+    started (see gunicorn.conf.py) or otherwise on the first request.
+    """
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    # Only send the session cookie when the session changes
+    app.config["SESSION_REFRESH_EACH_REQUEST"] = False
+    # Leave out the lines and indentation of template tags from pages
+    app.jinja_options = {
+        **app.jinja_options,
+        "trim_blocks": True,
+        "lstrip_blocks": True,
+    }
+    app.config.update(config_from_environment())
+    app.config.update(config or {})
+
+    if app.config["SECRET_KEY"] is None:
+        print("Environment Variable SESSION_KEY not set!")
+        exit(1)
+    if app.config["PASSWORD_SALT"] is None:
+        print("Environment Variable PASSWORD_SALT not set!")
+        exit(1)
+    if app.config["SESSION_STORE"] not in SESSION_STORES:
+        print(
+            f"Environment Variable SESSION_STORE must be one of "
+            f"{', '.join(SESSION_STORES)}, "
+            f"not '{app.config['SESSION_STORE']}'!"
+        )
+        exit(1)
+
+    if app.config["SQLITE_PROFILE"] not in SQLITE_PROFILES:
+        print(
+            f"Environment Variable SQLITE_PROFILE must be one of "
+            f"{', '.join(SQLITE_PROFILES)}, "
+            f"not '{app.config['SQLITE_PROFILE']}'!"
+        )
+        exit(1)
+
+    # Define "permanent" as 1 year and not the default 31 days
+    app.permanent_session_lifetime = timedelta(days=365)
+
+    database_uri = app.config["SQLALCHEMY_DATABASE_URI"]
+    use_sqlite_profile = (
+        database_uri.startswith("sqlite:///")
+        and database_uri != "sqlite:///:memory:"
+        and app.config["SQLITE_PROFILE"] == "production"
+    )
+    if use_sqlite_profile:
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+            **sqlite_engine_options(app.config["SQLITE_POOL_SIZE"]),
+            **app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}),
+        }
+    elif not database_uri.startswith("sqlite:"):
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+            **server_engine_options(app.config),
+            **app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}),
+        }
+    db.init_app(app)
+    if use_sqlite_profile:
+        # Creating the engine does not connect to the database
+        with app.app_context():
+            event.listen(db.engine, "connect", set_sqlite_pragmas)
+    summary_cache.max_bytes = app.config["SUMMARY_CACHE_MAX_BYTES"]
+
+    if app.config["SESSION_STORE"] == "memory":
+        app.session_interface = sessions.ServerSideSessionInterface(
+            sessions.MemorySessionStore()
+        )
+    elif app.config["SESSION_STORE"] == "database":
+        app.session_interface = sessions.ServerSideSessionInterface(
+            sessions.DatabaseSessionStore(db, StoredSession.__table__)
+        )
+
+    metrics.server_timing = app.config["SERVER_TIMING"]
+    if app.config["METRICS_ENABLED"] or app.config["SERVER_TIMING"]:
+        metrics.init_app(app, endpoint=app.config["METRICS_ENABLED"])
+    if app.config["MINIFY_HTML"] or app.config["COMPRESS_RESPONSES"]:
+        response_compression.init_app(app)
+
+    static_assets.init_app(app)
+
+    if app.config["CONCURRENT_READS"] > 0:
+        # Threads are only started when work is first submitted, so the app
+        # can still be created before gunicorn forks its workers
+        app.extensions["read_executor"] = ThreadPoolExecutor(
+            max_workers=app.config["CONCURRENT_READS"],
+            thread_name_prefix="bluesheet-read",
+        )
+
+    app.before_request(lambda: init_database(app))
+    app.before_request(take_missing_snapshot)
+    app.after_request(set_response_headers)
+    for rule, func, options in routes:
+        app.add_url_rule(rule, view_func=func, **options)
+
+    return app
+
+
+def sqlite_engine_options(pool_size):
+    """Engine options for the "production" SQLite profile. Connections are
+    kept in a pool, rather than opened for every request, so that the
+    pragmas and page cache are reused."""
+    return {
+        "poolclass": QueuePool,
+        "pool_size": pool_size,
+        "max_overflow": pool_size,
+        "connect_args": {
+            "check_same_thread": False,
+            "timeout": SQLITE_PRAGMAS["busy_timeout"] / 1000,
+        },
+    }
+
+
+def server_engine_options(config):
+    """Engine options for client/server databases such as PostgreSQL. Each
+    process keeps up to DATABASE_POOL_SIZE connections open, opening up to
+    DATABASE_MAX_OVERFLOW more when busy, so the database must accept that
+    many connections for every gunicorn worker of every app node.
+    Connections are checked before use (DATABASE_POOL_PRE_PING) and replaced
+    after DATABASE_POOL_RECYCLE seconds, so that connections dropped by the
+    server or a proxy aren't handed to requests."""
+    return {
+        "pool_size": config["DATABASE_POOL_SIZE"],
+        "max_overflow": config["DATABASE_MAX_OVERFLOW"],
+        "pool_timeout": config["DATABASE_POOL_TIMEOUT"],
+        "pool_recycle": config["DATABASE_POOL_RECYCLE"],
+        "pool_pre_ping": config["DATABASE_POOL_PRE_PING"],
+    }
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+
+# The databases initialised by this process, inherited by forked workers
+initialised_databases = set()
+init_database_lock = Lock()
+
+
+def init_database(app):
+    """Upgrades the database (see upgrade_database) and creates or updates
+    the user set by environment variables (see env_user), once per database
+    per process. Connections are closed afterwards so that none are shared
+    with forked worker processes."""
+    database_uri = app.config["SQLALCHEMY_DATABASE_URI"]
+    if database_uri in initialised_databases:
+        return
+
+    with init_database_lock:
+        if database_uri in initialised_databases:
+            return
+        with app.app_context():
+            upgrade_database()
+            env_user()
+            db.session.remove()
+            db.get_engine(app).dispose()
+        initialised_databases.add(database_uri)
+
+
+app = create_app()
 # endregion
@@ -0,0 +1,232 @@
+#!/usr/bin/python3
+
+import hashlib
+import hmac
+import secrets
+from base64 import b64decode, b64encode
+from os import cpu_count, environ
+from threading import BoundedSemaphore
+from time import perf_counter
+
+import helpers as h
+
+DEFAULT_HASHER = "scrypt"
+DEFAULT_SCRYPT_N = 2**14
+DEFAULT_SCRYPT_R = 8
+DEFAULT_SCRYPT_P = 1
+DEFAULT_PBKDF2_ITERATIONS = 600000
+SALT_BYTES = 16
+HASH_BYTES = 32
+
+
+class ScryptHasher:
+    """Memory hard hashing using hashlib.scrypt. Each hash uses roughly
+    128 * n * r bytes of memory."""
+
+    algorithm = "scrypt"
+
+    def __init__(
+        self, n=DEFAULT_SCRYPT_N, r=DEFAULT_SCRYPT_R, p=DEFAULT_SCRYPT_P
+    ):
+        self.n = int(n)
+        self.r = int(r)
+        self.p = int(p)
+
+    @property
+    def parameters(self):
+        return f"n={self.n},r={self.r},p={self.p}"
+
+    def derive(self, password, salt):
+        return hashlib.scrypt(
+            password.encode(),
+            salt=salt,
+            n=self.n,
+            r=self.r,
+            p=self.p,
+            maxmem=129 * self.n * self.r * self.p + 1024 * 1024,
+            dklen=HASH_BYTES,
+        )
+
+    @classmethod
+    def from_parameters(cls, parameters):
+        values = dict(item.split("=") for item in parameters.split(","))
+        return cls(values["n"], values["r"], values["p"])
+
+    def environment(self):
+        return {
+            "PASSWORD_HASHER": self.algorithm,
+            "PASSWORD_SCRYPT_N": self.n,
+            "PASSWORD_SCRYPT_R": self.r,
+            "PASSWORD_SCRYPT_P": self.p,
+        }
+
+    def stronger(self):
+        return ScryptHasher(self.n * 2, self.r, self.p)
+
+
+class PBKDF2Hasher:
+    """PBKDF2-HMAC-SHA256 using hashlib.pbkdf2_hmac, for hosts where the
+    memory used by scrypt is a problem."""
+
+    algorithm = "pbkdf2_sha256"
+
+    def __init__(self, iterations=DEFAULT_PBKDF2_ITERATIONS):
+        self.iterations = int(iterations)
+
+    @property
+    def parameters(self):
+        return f"i={self.iterations}"
+
+    def derive(self, password, salt):
+        return hashlib.pbkdf2_hmac(
+            "sha256", password.encode(), salt, self.iterations, HASH_BYTES
+        )
+
+    @classmethod
+    def from_parameters(cls, parameters):
+        return cls(parameters.split("=")[1])
+
+    def environment(self):
+        return {
+            "PASSWORD_HASHER": self.algorithm,
+            "PASSWORD_PBKDF2_ITERATIONS": self.iterations,
+        }
+
+
+HASHERS = {
+    ScryptHasher.algorithm: ScryptHasher,
+    PBKDF2Hasher.algorithm: PBKDF2Hasher,
+}
+
+
+def configured_hasher():
+    """Returns the hasher used for new passwords, as set by the PASSWORD_*
+    environment variables (see bluesheet.py calibrate-passwords)."""
+    algorithm = environ.get("PASSWORD_HASHER", DEFAULT_HASHER)
+    if algorithm == PBKDF2Hasher.algorithm:
+        return PBKDF2Hasher(
+            environ.get(
+                "PASSWORD_PBKDF2_ITERATIONS", DEFAULT_PBKDF2_ITERATIONS
+            )
+        )
+    elif algorithm == ScryptHasher.algorithm:
+        return ScryptHasher(
+            environ.get("PASSWORD_SCRYPT_N", DEFAULT_SCRYPT_N),
+            environ.get("PASSWORD_SCRYPT_R", DEFAULT_SCRYPT_R),
+            environ.get("PASSWORD_SCRYPT_P", DEFAULT_SCRYPT_P),
+        )
+    raise ValueError(
+        f"Unknown PASSWORD_HASHER '{algorithm}', "
+        f"expected one of {', '.join(HASHERS)}."
+    )
+
+
+hasher = configured_hasher()
+# Limits the number of password hashes calculated at once by each process so
+# that a burst of logins queues rather than using every CPU.
+_hash_slots = BoundedSemaphore(
+    int(environ.get("PASSWORD_MAX_CONCURRENT_HASHES", cpu_count() or 1))
+)
+
+
+def hash_password(password):
+    """Returns a string containing the algorithm, parameters, salt and hash
+    of the password, suitable for storing against the user."""
+    salt = secrets.token_bytes(SALT_BYTES)
+    with _hash_slots:
+        derived = hasher.derive(password, salt)
+    return "$".join(
+        [
+            hasher.algorithm,
+            hasher.parameters,
+            b64encode(salt).decode(),
+            b64encode(derived).decode(),
+        ]
+    )
+
+
+def is_legacy_hash(stored_hash):
+    """Stored hashes from before salted hashing was added are a SHA-256
+    hex digest of the password and the global PASSWORD_SALT."""
+    return "$" not in stored_hash
+
+
+def verify_password(password, stored_hash, legacy_salt=""):
+    """Returns True if the password matches the stored hash. Hashes are
+    compared in constant time."""
+    if is_legacy_hash(stored_hash):
+        return hmac.compare_digest(h.hash(password, legacy_salt), stored_hash)
+
+    # A corrupt or truncated hash, including bad base64 or invalid hasher
+    # parameters, never matches
+    try:
+        algorithm, parameters, salt, expected = stored_hash.split("$")
+        stored_hasher = HASHERS[algorithm].from_parameters(parameters)
+        salt, expected = b64decode(salt), b64decode(expected)
+        with _hash_slots:
+            derived = stored_hasher.derive(password, salt)
+    except (KeyError, IndexError, ValueError, OverflowError):
+        return False
+    return hmac.compare_digest(derived, expected)
+
+
+# A hash made with the configured hasher that no password matches. Verifying
+# a password against it takes as long as verifying a real user's password,
+# so it is used when there is no user to check against so that the time
+# taken to log in doesn't reveal which usernames exist.
+DUMMY_HASH = "$".join(
+    [
+        hasher.algorithm,
+        hasher.parameters,
+        b64encode(bytes(SALT_BYTES)).decode(),
+        b64encode(bytes(HASH_BYTES)).decode(),
+    ]
+)
+
+
+def needs_rehash(stored_hash):
+    """Returns True if the stored hash was not created with the configured
+    hasher and parameters, so should be replaced at the next login."""
+    if is_legacy_hash(stored_hash):
+        return True
+    algorithm, parameters = stored_hash.split("$")[:2]
+    return (algorithm, parameters) != (hasher.algorithm, hasher.parameters)
+
+
+def time_hash(candidate, rounds=3):
+    """Returns the median time in milliseconds taken by the hasher to hash a
+    password."""
+    timings = []
+    for _ in range(rounds):
+        start = perf_counter()
+        candidate.derive("calibration", secrets.token_bytes(SALT_BYTES))
+        timings.append((perf_counter() - start) * 1000)
+    return sorted(timings)[len(timings) // 2]
+
+
+def calibrate(algorithm, target_ms, max_memory_mib=64):
+    """Returns a (hasher, milliseconds) tuple for the strongest work factor
+    that takes no longer than target_ms to verify on this host.
+
+    scrypt's n must be a power of 2 so it is doubled until the target is
+    exceeded, and capped so that a hash uses no more than max_memory_mib.
+    PBKDF2 scales linearly with iterations so they are set from a timed run.
+    """
+    if algorithm == PBKDF2Hasher.algorithm:
+        sample = PBKDF2Hasher(100000)
+        iterations = sample.iterations * target_ms / time_hash(sample)
+        candidate = PBKDF2Hasher(max(int(iterations), 1000))
+        return candidate, time_hash(candidate)
+
+    best = ScryptHasher(2**10)
+    best_ms = time_hash(best)
+    while best_ms < target_ms:
+        candidate = best.stronger()
+        if 128 * candidate.n * candidate.r > max_memory_mib * 1024**2:
+            break
+        milliseconds = time_hash(candidate)
+        if milliseconds > target_ms:
+            break
+        best, best_ms = candidate, milliseconds
+
+    return best, best_ms
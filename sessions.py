@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+
+import secrets
+from collections import OrderedDict
+from datetime import datetime
+from hashlib import sha256
+from threading import Lock
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+SESSION_ID_BYTES = 32
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """A session whose data is kept in a session store. Clearing the session
+    (e.g. at login or logout) causes a new session id to be issued."""
+
+    def __init__(self, initial=None, sid=None):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.modified = False
+        self.cleared = False
+
+    def clear(self):
+        super().clear()
+        self.cleared = True
+
+
+class MemorySessionStore:
+    """Keeps sessions in the memory of the current process, so is only
+    suitable when the app is run in a single process. Expired sessions are
+    evicted when they are next read and the least recently used sessions are
+    evicted once there are more than max_entries."""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < datetime.utcnow():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return dict(entry[1])
+
+    def set(self, key, data, expires):
+        with self._lock:
+            self._entries[key] = (expires, dict(data))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class DatabaseSessionStore:
+    """Keeps sessions in a database table, shared by every process. The
+    table is accessed with Core statements on their own connection so that
+    session writes are independent of the request's ORM session. Expired
+    sessions are removed whenever a new session is created. Expiry times are
+    in UTC."""
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, db, table):
+        self.db = db
+        self.table = table
+
+    def get(self, key):
+        with self.db.engine.connect() as connection:
+            row = connection.execute(
+                self.db.select(self.table.c.data).where(
+                    self.table.c.id == key,
+                    self.table.c.expires >= datetime.utcnow(),
+                )
+            ).first()
+        return None if row is None else self.serializer.loads(row.data)
+
+    def set(self, key, data, expires):
+        values = {
+            "data": self.serializer.dumps(dict(data)),
+            "expires": expires,
+        }
+        with self.db.engine.begin() as connection:
+            updated = connection.execute(
+                self.table.update()
+                .where(self.table.c.id == key)
+                .values(**values)
+            )
+            if updated.rowcount == 0:
+                connection.execute(
+                    self.table.delete().where(
+                        self.table.c.expires < datetime.utcnow()
+                    )
+                )
+                connection.execute(
+                    self.table.insert().values(id=key, **values)
+                )
+
+    def delete(self, key):
+        with self.db.engine.begin() as connection:
+            connection.execute(
+                self.table.delete().where(self.table.c.id == key)
+            )
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """Stores session data server side and only an opaque random session id
+    in the cookie. The store is only written when the session is modified
+    and the cookie only set when the session id changes or the session is
+    modified. Session ids are hashed before being used as store keys."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            data = self.store.get(self._key(sid))
+            if data is not None:
+                return ServerSideSession(data, sid=sid)
+        return ServerSideSession()
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.accessed:
+            response.vary.add("Cookie")
+
+        if session.sid is not None and (session.cleared or not session):
+            self.store.delete(self._key(session.sid))
+            if not session:
+                response.delete_cookie(name, domain=domain, path=path)
+                return
+            session.sid = None
+
+        if not session or not session.modified:
+            return
+
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(SESSION_ID_BYTES)
+        self.store.set(
+            self._key(session.sid),
+            session,
+            datetime.utcnow() + app.permanent_session_lifetime,
+        )
+        response.set_cookie(
+            name,
+            session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+    @staticmethod
+    def _key(sid):
+        return sha256(sid.encode()).hexdigest()
@@ -26,3 +26,17 @@ function delete_warning(type, id, name) {
     }
   }
 }
+
+function bulk_outgoings_warning(form) {
+  var selected = document.querySelectorAll(`input[name="outgoing_id"][form="${form.id}"]:checked`).length;
+  if (selected == 0) {
+    window.alert("Please select one or more outgoings first.");
+    return false;
+  }
+
+  if (form.elements["action"].value == "delete") {
+    return window.confirm(`Are you sure you want to delete the ${selected} selected outgoing(s)?`);
+  }
+
+  return true;
+}
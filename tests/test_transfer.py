@@ -0,0 +1,90 @@
+import json
+import unittest
+from io import BytesIO
+from decimal import Decimal
+
+import transfer
+
+
+def parse_jsonl(*rows):
+    lines = [json.dumps(row) for row in rows]
+    return transfer.parse_rows(transfer.read_rows(lines, "jsonl"))
+
+
+class ParseRowsTest(unittest.TestCase):
+    def test_notes_object_is_a_row_error(self):
+        with self.assertRaises(transfer.InvalidImport) as e:
+            parse_jsonl(
+                {"type": "account", "name": "Bank", "notes": {"a": 1}},
+                {"type": "account", "name": "Savings", "notes": "Fine"},
+            )
+        self.assertEqual(e.exception.errors, ["Row 1: Notes must be text."])
+
+    def test_name_object_is_a_row_error(self):
+        with self.assertRaises(transfer.InvalidImport) as e:
+            parse_jsonl({"type": "account", "name": ["Bank"]})
+        self.assertEqual(e.exception.errors, ["Row 1: Name must be text."])
+
+    def test_huge_value_is_a_row_error(self):
+        with self.assertRaises(transfer.InvalidImport) as e:
+            parse_jsonl(
+                {
+                    "type": "annual_expense",
+                    "name": "Car tax",
+                    "value": "1e400",
+                    "month_paid": 3,
+                }
+            )
+        self.assertEqual(
+            e.exception.errors,
+            ["Row 1: Value must be no more than 999,999,999.99."],
+        )
+
+    def test_values_are_stored_to_the_penny(self):
+        (row,) = parse_jsonl(
+            {
+                "type": "outgoing",
+                "account": "Bank",
+                "name": "Rent",
+                "value": 1.005,
+            }
+        )
+        self.assertEqual(row["value"], Decimal("1.01"))
+
+
+class ReadOnlyStream:
+    """A binary stream with only read(), like an upload stream on Python
+    versions before 3.11."""
+
+    def __init__(self, data):
+        self.buffer = BytesIO(data)
+
+    def read(self, size=-1):
+        return self.buffer.read(size)
+
+
+class TextStreamTest(unittest.TestCase):
+    def test_quoted_line_separators_are_kept(self):
+        data = (
+            "\ufefftype,name,notes\r\n"
+            'account,Bank,"one\u2028two\x85three\r\nfour"\r\n'
+        ).encode()
+        rows = list(
+            transfer.read_rows(
+                transfer.text_stream(ReadOnlyStream(data)), "csv"
+            )
+        )
+        self.assertEqual(
+            rows,
+            [
+                {
+                    "type": "account",
+                    "name": "Bank",
+                    "notes": "one\u2028two\x85three\r\nfour",
+                }
+            ],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
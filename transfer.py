@@ -0,0 +1,275 @@
+#!/usr/bin/python3
+
+import csv
+import json
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+from io import BufferedReader, RawIOBase, StringIO, TextIOWrapper
+
+import helpers as h
+
+FORMATS = ("csv", "jsonl", "json")
+
+# The columns used for imported and exported rows. Account rows use name and
+# notes, outgoing rows reference their account by name.
+FIELDS = [
+    "type",
+    "account",
+    "name",
+    "value",
+    "start_month",
+    "end_month",
+    "month_paid",
+    "notes",
+    "emergency_fund_excluded",
+]
+ROW_TYPES = ("account", "outgoing", "annual_expense")
+# Exports also include a configuration row for each user. These rows are
+# skipped when importing.
+CONFIGURATION_FIELDS = [
+    "annual_net_salary",
+    "emergency_fund_months",
+    "annual_expense_outgoing",
+]
+EXPORT_FIELDS = FIELDS + CONFIGURATION_FIELDS
+SKIPPED_ROW_TYPES = ("configuration",)
+MIMETYPES = {
+    "csv": "text/csv",
+    "jsonl": "application/x-ndjson",
+    "json": "application/json",
+}
+MAX_NAME_LENGTH = 255
+# Values are stored to the penny, as entered on the forms
+MAX_VALUE = Decimal("999999999.99")
+PENNY = Decimal("0.01")
+MAX_REPORTED_ERRORS = 20
+
+
+class InvalidImport(ValueError):
+    """Raised when one or more rows of an import are invalid. The individual
+    row errors are available as errors."""
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__("\n".join(errors))
+
+
+def format_from_filename(filename):
+    """Returns the import/export format implied by a file extension."""
+    extension = filename.rsplit(".", 1)[-1].lower()
+    if extension == "ndjson":
+        return "jsonl"
+    if extension not in FORMATS:
+        raise ValueError(
+            f"Unsupported file type '.{extension}', "
+            f"expected one of {', '.join(FORMATS)}."
+        )
+    return extension
+
+
+class _ReadableStream(RawIOBase):
+    """Wraps a binary stream that only provides read(), such as werkzeug's
+    upload streams which are SpooledTemporaryFiles with no readable() before
+    Python 3.11, so that it can be wrapped in a TextIOWrapper."""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.stream.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+
+def text_stream(stream):
+    """Returns a text stream reading UTF-8, with or without a byte order
+    mark, from a binary stream. Line endings are left for the csv module to
+    handle, so quoted fields may contain any line break."""
+    return TextIOWrapper(
+        BufferedReader(_ReadableStream(stream)),
+        encoding="utf-8-sig",
+        newline="",
+    )
+
+
+def read_rows(stream, format):
+    """Yields a dictionary for each row of a text stream in the given
+    format. CSV and JSON Lines are read a row at a time."""
+    if format == "csv":
+        yield from csv.DictReader(stream)
+    elif format == "jsonl":
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+    elif format == "json":
+        yield from json.load(stream)
+    else:
+        raise ValueError(f"Unsupported format '{format}'.")
+
+
+def write_rows(rows, format, fields):
+    """Yields the given rows as chunks of text in the given format, one chunk
+    per row, so that exports can be streamed. Only the given fields are
+    written, and empty fields are left out of JSON rows."""
+
+    def json_row(row):
+        return json.dumps(
+            {
+                field: row[field]
+                for field in fields
+                if row.get(field) is not None
+            }
+        )
+
+    if format == "csv":
+        buffer = StringIO()
+        writer = csv.DictWriter(buffer, fields, extrasaction="ignore")
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+    elif format == "jsonl":
+        for row in rows:
+            yield json_row(row) + "\n"
+    elif format == "json":
+        separator = "[\n"
+        for row in rows:
+            yield separator + json_row(row)
+            separator = ",\n"
+        yield "[]\n" if separator == "[\n" else "\n]\n"
+    else:
+        raise ValueError(f"Unsupported format '{format}'.")
+
+
+def parse_rows(rows):
+    """Validates and converts raw rows, returning a list of parsed rows in the
+    order they were read. Raises InvalidImport listing the invalid rows."""
+    parsed_rows = []
+    errors = []
+    try:
+        for row_number, row in enumerate(rows, start=1):
+            if isinstance(row, dict) and row.get("type") in SKIPPED_ROW_TYPES:
+                continue
+            try:
+                parsed_rows.append(parse_row(row))
+            except ValueError as e:
+                errors.append(f"Row {row_number}: {e}")
+                if len(errors) >= MAX_REPORTED_ERRORS:
+                    break
+    except UnicodeDecodeError:
+        errors.append("Unable to read file: it must be UTF-8 encoded text.")
+    except (ValueError, csv.Error) as e:  # Malformed CSV or JSON
+        errors.append(f"Unable to read file: {e}")
+
+    if len(errors) > 0:
+        raise InvalidImport(errors)
+    return parsed_rows
+
+
+def parse_row(row):
+    """Returns a copy of a raw row with the values for its type converted
+    to the types stored in the database."""
+    if not isinstance(row, dict):
+        raise ValueError("Expected an object.")
+    row = h.empty_strings_to_none(row)
+
+    row_type = row.get("type")
+    if row_type not in ROW_TYPES:
+        raise ValueError(
+            f"Type must be one of {', '.join(ROW_TYPES)}, not '{row_type}'."
+        )
+
+    parsed_row = {
+        "type": row_type,
+        "name": _parse_name(row.get("name"), "Name"),
+        "notes": _parse_notes(row.get("notes")),
+    }
+
+    if row_type == "outgoing":
+        parsed_row["account"] = _parse_name(row.get("account"), "Account")
+        parsed_row["value"] = _parse_value(row.get("value"))
+        parsed_row["start_month"] = _parse_month(row.get("start_month"))
+        parsed_row["end_month"] = _parse_month(
+            row.get("end_month"), set_to_last_day=True
+        )
+        if (
+            parsed_row["start_month"] is not None
+            and parsed_row["end_month"] is not None
+            and parsed_row["start_month"] > parsed_row["end_month"]
+        ):
+            raise ValueError("Start month is after end month.")
+        parsed_row["emergency_fund_excluded"] = _parse_boolean(
+            row.get("emergency_fund_excluded")
+        )
+    elif row_type == "annual_expense":
+        parsed_row["value"] = _parse_value(row.get("value"))
+        parsed_row["month_paid"] = _parse_month_paid(row.get("month_paid"))
+
+    return parsed_row
+
+
+def _parse_name(value, label):
+    if value is None:
+        raise ValueError(f"{label} is required.")
+    # Numbers are accepted as JSON rows may hold names such as 2024
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        raise ValueError(f"{label} must be text.")
+    value = str(value).strip()
+    if len(value) == 0 or len(value) > MAX_NAME_LENGTH:
+        raise ValueError(
+            f"{label} must be between 1 and {MAX_NAME_LENGTH} characters."
+        )
+    return value
+
+
+def _parse_value(value):
+    if value is None:
+        raise ValueError("Value is required.")
+    try:
+        value = Decimal(str(value).replace(",", "").lstrip("£"))
+    except InvalidOperation:
+        raise ValueError(f"Value '{value}' is not a number.")
+    if not value.is_finite() or value < 0:
+        raise ValueError("Value must be zero or more.")
+    if value > MAX_VALUE:
+        raise ValueError(f"Value must be no more than {MAX_VALUE:,}.")
+    return value.quantize(PENNY, rounding=ROUND_HALF_UP)
+
+
+def _parse_notes(value):
+    if value is not None and not isinstance(value, str):
+        raise ValueError("Notes must be text.")
+    return value
+
+
+def _parse_month(value, set_to_last_day=False):
+    try:
+        return h.month_input_to_date(value, set_to_last_day=set_to_last_day)
+    except (TypeError, ValueError):
+        raise ValueError(f"Month '{value}' is not in the format YYYY-MM.")
+
+
+def _parse_month_paid(value):
+    if value is None:
+        raise ValueError("Month paid is required.")
+    for month_num, month_name in h.months.items():
+        if str(value).strip().lower() in (str(month_num), month_name.lower()):
+            return month_num
+    raise ValueError(
+        f"Month paid '{value}' must be a month name or number from 1 to 12."
+    )
+
+
+def _parse_boolean(value):
+    if value is None or isinstance(value, bool):
+        return value is True
+    if str(value).strip().lower() in ("true", "yes", "y", "1", "on"):
+        return True
+    if str(value).strip().lower() in ("false", "no", "n", "0", "off"):
+        return False
+    raise ValueError(f"'{value}' is not a valid true/false value.")